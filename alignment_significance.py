@@ -1,14 +1,21 @@
 #!/usr/local/bin/python3
+import argparse
 from geometry import AlignmentTarget
-from computer import Computer, compute_all_azimuths
-from grapher import LocationGrapher, CircleGrapher, SignificanceGrapher
-from reader import DataReader
+from computer import Computer, marker_coordinates, pair_azimuths
+from cache import simulate_cached
+from telemetry import open_telemetry
+
+# The reader, the graphers and the report (pandas, pyproj, bokeh) are
+# imported where they are used, so that importing this module for its
+# constants, as batch and the workers do, stays cheap.
 
 # Define constants, including the alignment targets.
 DATA_FILE = './resources/Marcahuasi_markers.csv'
 TOLERANCES = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 1.5, 2.0, 2.5]
-NUMBER_SIMULATED = 100
+NUMBER_SIMULATED = 10000
 NUMBER_EXAMPLES = 1
+SEED = 0
+NUMBER_WORKERS = None
 ALIGNMENT_TARGETS = [AlignmentTarget("Equinox", "rise", 90),
                      AlignmentTarget("Equinox", "set", 270),
                      AlignmentTarget("Solstice", "Jun 21 rise", 66),
@@ -20,28 +27,107 @@ ALIGNMENT_TARGETS = [AlignmentTarget("Equinox", "rise", 90),
                      AlignmentTarget("Pleiades Last Appearance", "Pleiades on horizon", 290.8)]
 
 
-def main():
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description='Estimate the significance of marker alignments.')
+  parser.add_argument('--report', metavar='DIR',
+                      help='write every figure to DIR instead of opening them in a browser')
+  parser.add_argument('--format', choices=['html', 'png', 'svg'], default='html',
+                      help='file format for --report (png and svg need a browser driver)')
+  parser.add_argument('--no-tiles', action='store_true',
+                      help='do not draw map tiles, so no network access is needed')
+  parser.add_argument('--telemetry', metavar='FILE',
+                      help="append JSON lines with stage timings and progress to FILE ('-' for stderr)")
+  parser.add_argument('--profile', metavar='FILE',
+                      help='write cProfile stats of the simulation to FILE (runs it in a single process)')
+  parser.add_argument('--trace-memory', action='store_true',
+                      help='report peak traced memory of the simulation in the telemetry (runs it in a single process)')
+  parser.add_argument('--checkpoint', metavar='FILE',
+                      help='simulate in a single process, saving progress to FILE and resuming from it')
+  parser.add_argument('--uncertainty', metavar='N', type=int, default=0,
+                      help="score N copies of the markers jittered by their 'Error (meters)'")
+  return parser.parse_args(argv)
+
+
+def main(argv=None):
+  args = parse_args(argv)
+  from reader import DataReader
 
   # Read and create Markers from the data file.
   data_reader = DataReader(DATA_FILE)
   data_reader.read_marker_locations()
 
+  # Simulate the same number of random markers in the same region
+  # NUMBER_SIMULATED times, and for each set of simulated markers,
+  # determine the number that match at every tolerance in one pass,
+  # spread over NUMBER_WORKERS processes (all cores if None). Results
+  # are cached on disk and only extended if NUMBER_SIMULATED grows; a
+  # run that is killed resumes from its last checkpoint. The profiler and
+  # tracemalloc only see this process, so with either the simulation runs
+  # here instead of in worker processes, with the same results. With
+  # --checkpoint it also runs here, from a single random generator whose
+  # state is saved with the counts to the given file (see checkpoint).
+  # The telemetry file is closed once the simulation ends.
+  telemetry = open_telemetry(args.telemetry, args.profile, args.trace_memory)
+  max_workers = 0 if args.profile is not None or args.trace_memory else NUMBER_WORKERS
+  computer = Computer(markers=data_reader.markers,
+                      alignment_targets=ALIGNMENT_TARGETS,
+                      tolerance=max(TOLERANCES),
+                      telemetry=telemetry)
+  with telemetry, telemetry.run('simulation'):
+    if args.checkpoint is not None:
+      from checkpoint import Checkpoint, simulate_checkpointed
+      simulated_histograms = simulate_checkpointed(computer, NUMBER_SIMULATED, Checkpoint(args.checkpoint),
+                                                   seed=SEED, tolerances=TOLERANCES)
+    else:
+      simulated_histograms = simulate_cached(computer,
+                                             num_simulated=NUMBER_SIMULATED,
+                                             seed=SEED,
+                                             tolerances=TOLERANCES,
+                                             max_workers=max_workers)
+  lat, lon = marker_coordinates(data_reader.markers)
+  observed_matches = computer.count_alignments_by_tolerance(lat, lon, TOLERANCES)
+  p_values = [h.p_value(o) for (h, o) in zip(simulated_histograms, observed_matches)]
+
+  if args.report:
+    # Write all figures to files without a display.
+    from report import write_report
+    write_report(data_reader.markers, ALIGNMENT_TARGETS, TOLERANCES, simulated_histograms,
+                 output_dir=args.report, fmt=args.format, tiles=not args.no_tiles,
+                 num_examples=NUMBER_EXAMPLES, seed=SEED, max_workers=NUMBER_WORKERS)
+  else:
+    show_figures(data_reader.markers, simulated_histograms, tiles=not args.no_tiles)
+
+  # Report the p-value as a function of tolerance.
+  for tolerance, observed, significance in zip(TOLERANCES, observed_matches, p_values):
+    print(f'tolerance {tolerance} deg: {observed} alignments, p-value {significance:.5f}')
+
+  # Spread of the result over the markers' position errors.
+  if args.uncertainty > 0:
+    from uncertainty import positional_uncertainty
+    summary, _ = positional_uncertainty(computer, TOLERANCES, simulated_histograms, args.uncertainty, seed=SEED)
+    print(summary.to_string(index=False))
+
+
+def show_figures(markers, simulated_histograms, tiles=True):
+  from grapher import LocationGrapher, CircleGrapher, SignificanceGrapher
+
   # Create diagram using all pairs and targets.
-  all_pairs = compute_all_azimuths(data_reader.markers)
-  circle_grapher = CircleGrapher(all_pairs, ALIGNMENT_TARGETS)
+  all_azimuths = pair_azimuths(markers)
+  circle_grapher = CircleGrapher(all_azimuths, ALIGNMENT_TARGETS)
   circle_grapher.graph()
   circle_grapher.show()
 
   # Loop through each tolerance and compare the observed
   # number of alignments with the number that match when
   # the markers are simulated randomly.
-  for tolerance in TOLERANCES:
-    computer = Computer(markers=data_reader.markers,
+  for k, tolerance in enumerate(TOLERANCES):
+    computer = Computer(markers=markers,
                         alignment_targets=ALIGNMENT_TARGETS,
                         tolerance=tolerance)
+    computer.matches_histogram = simulated_histograms[k]
 
     # Graph the locations of the markers on a map.
-    grapher = LocationGrapher(computer.markers, tolerance)
+    grapher = LocationGrapher(computer.markers, tolerance, tiles=tiles)
     grapher.graph()
 
     # Determine how many alignments there are and graph
@@ -50,29 +136,23 @@ def main():
     grapher.plot_alignments(observed_alignments)
     grapher.show()
 
-    # Simulate the same number of random markers in the same region
-    # num_simulated times, and for each set of simulated markers,
-    # determine the number that match. Return num_examples of simulated
-    # sets of markers only for the purpose of graphing them on a map
+    # Plot NUMBER_EXAMPLES sets of simulated markers and alignments
     # for inspection.
-    list_of_simulated_markers = computer.simulate(num_simulated=NUMBER_SIMULATED,
-                                                  num_examples=NUMBER_EXAMPLES)
-    # Plot the returned sets of simulated markers and alignments for
-    # inspection.
-    for simulated_markers in list_of_simulated_markers:
-      grapher = LocationGrapher(simulated_markers, tolerance)
+    for _ in range(NUMBER_EXAMPLES):
+      simulated_markers = computer.random_markers()
+      grapher = LocationGrapher(simulated_markers, tolerance, tiles=tiles)
       grapher.graph()
       matches = computer.determine_alignments(simulated_markers)
       grapher.plot_alignments(matches)
       grapher.show()
 
     # Plot and report the statistical significance estimates.
-    significance_grapher = SignificanceGrapher(len(data_reader.markers),
+    significance_grapher = SignificanceGrapher(len(markers),
                                                tolerance,
-                                               computer.matches_list)
+                                               computer.matches_histogram)
     significance_grapher.graph(observed_alignments=len(observed_alignments))
+    significance_grapher.show()
     computer.report_significance(observed_alignments=len(observed_alignments))
 
-
 if __name__ == "__main__":
   main()
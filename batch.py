@@ -0,0 +1,117 @@
+#!/usr/local/bin/python3
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from alignment_significance import ALIGNMENT_TARGETS, TOLERANCES, NUMBER_SIMULATED, SEED
+from computer import Computer, SIMULATION_CHUNK_SIZE, marker_coordinates, simulate_chunk
+from geometry import AlignmentTarget
+from histogram import AlignmentHistogram
+
+# Significance analysis over many marker catalogs at once. Every site's
+# simulations are split into chunks that share one process pool. Chunks of
+# the largest sites, whose cost grows as N^2, are submitted first so that
+# the small sites fill in the gaps at the end. All tolerances of a site are
+# counted from the same simulated marker sets (see
+# Computer.simulated_counts), and each site uses the seed sequence of
+# simulate_parallel, so its numbers match a single-site run with the same
+# seed.
+#
+# The optional JSON config has the form
+#   {"targets": [{"category": ..., "name": ..., "azimuth": ...}, ...],
+#    "tolerances": [...],
+#    "count_aligned_pair_only_once": false}
+# with missing keys taken from alignment_significance.
+
+def read_config(filename=None):
+  config = {}
+  if filename is not None:
+    with open(filename) as f:
+      config = json.load(f)
+
+  if 'targets' in config:
+    targets = [AlignmentTarget(t['category'], t['name'], t['azimuth']) for t in config['targets']]
+  else:
+    targets = ALIGNMENT_TARGETS
+  tolerances = config.get('tolerances', TOLERANCES)
+  count_aligned_pair_only_once = config.get('count_aligned_pair_only_once', False)
+  return targets, tolerances, count_aligned_pair_only_once
+
+# Site files from a list of file names and glob patterns, without repeats.
+def find_sites(patterns):
+  sites = []
+  for pattern in patterns:
+    sites.extend(sorted(glob.glob(pattern)) or [pattern])
+  return list(dict.fromkeys(sites))
+
+def analyse_sites(sites, targets, tolerances, num_simulated, seed=None, count_aligned_pair_only_once=False,
+                  max_workers=None, chunk_size=SIMULATION_CHUNK_SIZE):
+  import pandas as pd
+  from reader import DataReader
+
+  computers = {}
+  for site in sites:
+    data_reader = DataReader(site)
+    data_reader.read_marker_locations()
+    computers[site] = Computer(data_reader.markers, targets, max(tolerances), count_aligned_pair_only_once)
+
+  # One task per chunk, largest sites first.
+  tasks = []
+  for site in sorted(sites, key=lambda s: -len(computers[s].markers) ** 2):
+    chunks = [min(chunk_size, num_simulated - start) for start in range(0, num_simulated, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    tasks.extend((site, n, seed_sequence) for (n, seed_sequence) in zip(chunks, seeds))
+
+  histograms = {site: [AlignmentHistogram() for _ in tolerances] for site in sites}
+  with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    futures = [(site, executor.submit(simulate_chunk, computers[site], n, seed_sequence, tolerances))
+               for (site, n, seed_sequence) in tasks]
+    for k, (site, future) in enumerate(futures):
+      for histogram, chunk_histogram in zip(histograms[site], future.result()):
+        histogram.merge(chunk_histogram)
+      print(f'chunk {k + 1} / {len(futures)}')
+
+  rows = []
+  for site in sites:
+    computer = computers[site]
+    lat, lon = marker_coordinates(computer.markers)
+    observed = computer.count_alignments_by_tolerance(lat, lon, tolerances)
+    for tolerance, observed_alignments, histogram in zip(tolerances, observed, histograms[site]):
+      rows.append({'site': site,
+                   'n_markers': len(computer.markers),
+                   'tolerance': tolerance,
+                   'observed_alignments': int(observed_alignments),
+                   'num_simulated': histogram.total(),
+                   'mean_simulated': histogram.mean(),
+                   'p_value': float(histogram.p_value(observed_alignments))})
+  return pd.DataFrame(rows)
+
+def write_results(results, filename):
+  if os.path.splitext(filename)[1] == '.parquet':
+    results.to_parquet(filename, index=False)
+  else:
+    results.to_csv(filename, index=False)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Estimate the significance of marker alignments at many sites.')
+  parser.add_argument('sites', nargs='+', help='marker CSV files or glob patterns')
+  parser.add_argument('--config', help='JSON file with targets and tolerances')
+  parser.add_argument('--simulations', type=int, default=NUMBER_SIMULATED, help='simulations per site')
+  parser.add_argument('--seed', type=int, default=SEED)
+  parser.add_argument('--workers', type=int, default=None, help='worker processes (all cores by default)')
+  parser.add_argument('--output', default='results.csv', help='results table (.csv or .parquet)')
+  args = parser.parse_args(argv)
+
+  targets, tolerances, count_aligned_pair_only_once = read_config(args.config)
+  results = analyse_sites(find_sites(args.sites), targets, tolerances, args.simulations, seed=args.seed,
+                          count_aligned_pair_only_once=count_aligned_pair_only_once,
+                          max_workers=args.workers)
+  write_results(results, args.output)
+  print(f'wrote {args.output}')
+
+
+if __name__ == "__main__":
+  main()
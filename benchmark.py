@@ -0,0 +1,230 @@
+#!/usr/local/bin/python3
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from computer import Computer
+from geometry import AlignmentTarget, MarkerSet
+from projection import lat_lon_to_web_mercator, web_mercator_to_lat_lon
+from utils import atomic_path
+
+# Benchmarks of the hot paths: alignment detection on one marker set,
+# simulation of random marker sets, and rendering of the circle and location
+# figures. Every case runs on synthetic markers spread uniformly over a disc
+# the size of the Marcahuasi plateau, so nothing is read from disk or the
+# network. For each case the best wall time over the repeats, iterations per
+# second and peak memory (from tracemalloc, in a separate run so tracing
+# does not slow the timed ones) are recorded and written to a JSON file,
+# which is rewritten as each case finishes. A case that fails, e.g. by
+# running out of memory, is recorded with its error and the others still
+# run. Simulation cases run fewer simulations where needed to stay within
+# MAX_SIMULATED_ENTRIES mask entries (simulations * markers^2 * targets),
+# but always at least one, so the largest catalogs are simulated too. With
+# --compare, a case that is slower or uses more memory than in an earlier
+# results file by more than the allowed factor, or that fails when it did
+# not before, is reported. The script exits with status 1 on a regression
+# or a failed case.
+
+MARKER_COUNTS = [10, 100, 1000, 5000]
+TARGET_COUNTS = [9, 36]
+TOLERANCES = [0.5, 2.5]
+SIMULATION_COUNTS = [100, 1000]
+STAGES = ['alignment', 'simulation', 'rendering']
+REPEATS = 3
+SEED = 0
+
+# Simulation cases with more mask entries than this run fewer simulations.
+MAX_SIMULATED_ENTRIES = 4 * 10 ** 8
+
+# Allowed growth of wall time and peak memory against --compare.
+MAX_SLOWDOWN = 1.25
+MAX_MEMORY_GROWTH = 1.25
+
+# Differences below these (seconds, bytes) are noise and never reported.
+MIN_TIME_DIFFERENCE = 0.005
+MIN_MEMORY_DIFFERENCE = 2 ** 20
+
+SITE_LAT = -11.775
+SITE_LON = -76.581
+SITE_RADIUS = 400.0
+
+TARGET_CATEGORIES = ['Equinox', 'Solstice', 'Zenith Passage', 'Pleiades Last Appearance']
+
+def synthetic_markers(n_markers, rng):
+  center_x, center_y = lat_lon_to_web_mercator(SITE_LAT, SITE_LON)
+  r = SITE_RADIUS * np.sqrt(rng.uniform(size=n_markers))
+  theta = rng.uniform(0, 2 * np.pi, size=n_markers)
+  x = center_x + r * np.cos(theta)
+  y = center_y + r * np.sin(theta)
+  lat, lon = web_mercator_to_lat_lon(x, y)
+  return MarkerSet(x, y, lat, lon, [f'Marker {i + 1}' for i in range(n_markers)])
+
+# Evenly spread targets, offset so none falls on a cardinal direction.
+def synthetic_targets(n_targets):
+  return [AlignmentTarget(TARGET_CATEGORIES[k % len(TARGET_CATEGORIES)], f'target {k}', (7.3 + k * 360 / n_targets) % 360)
+          for k in range(n_targets)]
+
+# Benchmark cases as (name, parameters). Iterations are marker sets, so
+# simulations is 1 except for the simulation stage.
+def benchmark_cases(stages, marker_counts, target_counts, tolerances, simulation_counts):
+  cases = []
+  for stage in stages:
+    if stage == 'alignment':
+      grid = itertools.product(marker_counts, target_counts, tolerances, [1])
+    elif stage == 'simulation':
+      grid = itertools.product(marker_counts, target_counts, tolerances, simulation_counts)
+    elif stage == 'rendering':
+      grid = itertools.product(marker_counts, target_counts[:1], tolerances[:1], [1])
+    else:
+      raise ValueError(f'unknown stage {stage}')
+
+    for n_markers, n_targets, tolerance, num_simulated in grid:
+      if stage == 'simulation':
+        num_simulated = min(num_simulated, max(1, MAX_SIMULATED_ENTRIES // (n_markers ** 2 * n_targets)))
+      params = {'stage': stage, 'markers': n_markers, 'targets': n_targets, 'tolerance': tolerance,
+                'simulations': num_simulated}
+      name = f'{stage}[markers={n_markers},targets={n_targets},tolerance={tolerance}'
+      name += f',simulations={num_simulated}]' if stage == 'simulation' else ']'
+      if name not in dict(cases):
+        cases.append((name, params))
+  return cases
+
+def case_function(params):
+  rng = np.random.default_rng(SEED)
+  markers = synthetic_markers(params['markers'], rng)
+  targets = synthetic_targets(params['targets'])
+  computer = Computer(markers, targets, params['tolerance'])
+
+  if params['stage'] == 'alignment':
+    return lambda: computer.determine_alignments(markers)
+  if params['stage'] == 'simulation':
+    return lambda: computer.simulated_counts(params['simulations'], rng=np.random.default_rng(SEED), progress=False)
+  return lambda: render(markers, targets, params['tolerance'])
+
+# Build the circle and location figures and serialize them to HTML, which
+# is where bokeh does most of its work.
+def render(markers, targets, tolerance):
+  from bokeh.embed import file_html
+  from bokeh.resources import CDN
+  from report import circle_figure, location_figure
+  file_html(circle_figure(markers, targets), CDN)
+  file_html(location_figure(markers, targets, tolerance, tiles=False), CDN)
+
+def run_case(name, params, repeats):
+  function = case_function(params)
+  function()
+
+  times = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - start)
+
+  tracemalloc.start()
+  function()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  wall_time = min(times)
+  result = dict(params, name=name, wall_time=wall_time, iterations_per_second=params['simulations'] / wall_time,
+                peak_memory=peak)
+  print(f'{name}: {wall_time:.4f} s, {result["iterations_per_second"]:.1f} it/s, {peak / 2 ** 20:.1f} MiB')
+  return result
+
+# Run every case, writing the results so far to output after each one. A
+# case that raises is recorded with its error instead of its measurements.
+def run_benchmarks(cases, repeats=REPEATS, output=None):
+  results = {'metadata': {'python': platform.python_version(),
+                          'numpy': np.__version__,
+                          'platform': platform.platform(),
+                          'processor': platform.processor(),
+                          'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                          'repeats': repeats},
+             'results': []}
+  for name, params in cases:
+    try:
+      result = run_case(name, params, repeats)
+    except Exception as error:
+      if tracemalloc.is_tracing():
+        tracemalloc.stop()
+      result = dict(params, name=name, error=f'{type(error).__name__}: {error}')
+      print(f'{name}: FAILED ({result["error"]})')
+    results['results'].append(result)
+    if output is not None:
+      write_results(results, output)
+  return results
+
+# Written atomically, so the file is never left half-written.
+def write_results(results, output):
+  with atomic_path(output) as temporary, open(temporary, 'w') as f:
+    json.dump(results, f, indent=2)
+
+def failed_cases(results):
+  return [r for r in results['results'] if 'error' in r]
+
+# Cases present in both runs that got slower or bigger than allowed, or
+# that fail now but did not before.
+def find_regressions(results, baseline, max_slowdown=MAX_SLOWDOWN, max_memory_growth=MAX_MEMORY_GROWTH):
+  previous = {r['name']: r for r in baseline['results']}
+  regressions = []
+  for result in results['results']:
+    if result['name'] not in previous or 'error' in previous[result['name']]:
+      continue
+    before = previous[result['name']]
+    if 'error' in result:
+      regressions.append(f'{result["name"]}: fails with {result["error"]}')
+      continue
+    slowdown = result['wall_time'] / before['wall_time']
+    memory_growth = result['peak_memory'] / max(before['peak_memory'], 1)
+    if slowdown > max_slowdown and result['wall_time'] - before['wall_time'] > MIN_TIME_DIFFERENCE:
+      regressions.append(f'{result["name"]}: wall time {before["wall_time"]:.4f} s -> {result["wall_time"]:.4f} s '
+                         f'({slowdown:.2f}x)')
+    if memory_growth > max_memory_growth and result['peak_memory'] - before['peak_memory'] > MIN_MEMORY_DIFFERENCE:
+      regressions.append(f'{result["name"]}: peak memory {before["peak_memory"] / 2 ** 20:.1f} MiB -> '
+                         f'{result["peak_memory"] / 2 ** 20:.1f} MiB ({memory_growth:.2f}x)')
+  return regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark alignment detection, simulation and rendering.')
+  parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+  parser.add_argument('--markers', nargs='+', type=int, default=MARKER_COUNTS)
+  parser.add_argument('--targets', nargs='+', type=int, default=TARGET_COUNTS)
+  parser.add_argument('--tolerances', nargs='+', type=float, default=TOLERANCES)
+  parser.add_argument('--simulations', nargs='+', type=int, default=SIMULATION_COUNTS)
+  parser.add_argument('--repeats', type=int, default=REPEATS)
+  parser.add_argument('--output', default='benchmark.json', help='results file')
+  parser.add_argument('--compare', metavar='BASELINE', help='earlier results file to check for regressions')
+  parser.add_argument('--max-slowdown', type=float, default=MAX_SLOWDOWN)
+  parser.add_argument('--max-memory-growth', type=float, default=MAX_MEMORY_GROWTH)
+  args = parser.parse_args(argv)
+
+  cases = benchmark_cases(args.stages, args.markers, args.targets, args.tolerances, args.simulations)
+  results = run_benchmarks(cases, args.repeats, args.output)
+  print(f'wrote {args.output}')
+  failures = failed_cases(results)
+  if failures:
+    print(f'{len(failures)} of {len(cases)} cases FAILED:')
+    for failure in failures:
+      print(f'  {failure["name"]}: {failure["error"]}')
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    regressions = find_regressions(results, baseline, args.max_slowdown, args.max_memory_growth)
+    if regressions:
+      print(f'REGRESSIONS against {args.compare}:')
+      for regression in regressions:
+        print(f'  {regression}')
+      sys.exit(1)
+    print(f'no regressions against {args.compare}')
+  if failures:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
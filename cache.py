@@ -0,0 +1,122 @@
+import hashlib
+import os
+import time
+import numpy as np
+from histogram import AlignmentHistogram, stack_bins, unstack_bins
+from computer import SIMULATION_CHUNK_SIZE
+from utils import atomic_path
+
+# Directory holding cached simulation results.
+CACHE_DIR = './cache'
+
+# Bump when a change to the simulation changes its results, so that
+# entries written by older code are not reused.
+CACHE_VERSION = 3
+
+# Seconds between saves of a partial entry while simulate_cached runs.
+CHECKPOINT_INTERVAL = 300.0
+
+# Hash of everything that determines the simulated counts: the marker
+# coordinates, the target azimuths, the tolerances (computer.tolerance
+# without them), the counting options, the seed and the chunk (or batch)
+# size.
+def simulation_key(computer, tolerances, seed, chunk_size):
+  digest = hashlib.sha256()
+  for coordinates in (computer.marker_set.x, computer.marker_set.y, computer.marker_set.lat, computer.marker_set.lon):
+    digest.update(coordinates.tobytes())
+  digest.update(computer.target_azimuths.tobytes())
+  scored = computer.tolerance if tolerances is None else tolerances
+  digest.update(np.atleast_1d(np.asarray(scored, dtype=np.float64)).tobytes())
+  digest.update(repr((CACHE_VERSION, tolerances is None, computer.count_aligned_pair_only_once,
+                      computer.planar_azimuths, seed, chunk_size)).encode())
+  return digest.hexdigest()
+
+# Disk cache of simulated alignment-count histograms. Entries are keyed by
+# simulation_key. Each entry is an .npz file with the
+# histogram bins, the number of simulations and the seed entropy, so a
+# later run can append more chunks to it instead of starting over.
+class SimulationCache:
+
+  def __init__(self, directory=CACHE_DIR):
+    self.directory = directory
+
+  def key(self, computer, tolerances, seed, chunk_size):
+    return simulation_key(computer, tolerances, seed, chunk_size)
+
+  def path(self, key):
+    return os.path.join(self.directory, f'{key}.npz')
+
+  # Returns (entropy, num_simulated, histograms) or None if there is no entry.
+  def load(self, key):
+    path = self.path(key)
+    if not os.path.exists(path):
+      return None
+    with np.load(path) as entry:
+      return int(str(entry['entropy'])), int(entry['num_simulated']), unstack_bins(entry['bins'])
+
+  # Written atomically, so a crash never leaves a partial entry behind.
+  def save(self, key, entropy, num_simulated, histograms):
+    os.makedirs(self.directory, exist_ok=True)
+    with atomic_path(self.path(key)) as temporary:
+      np.savez_compressed(temporary, bins=stack_bins(histograms), num_simulated=num_simulated, entropy=str(entropy))
+
+# Computer.simulate_parallel backed by a SimulationCache. At least
+# num_simulated simulations are returned: a cached entry is reused as is
+# if it is large enough and otherwise extended with the missing chunks,
+# continuing its seed sequence. Extending an entry whose size is a multiple
+# of chunk_size gives exactly the counts of a single longer run.
+#
+# While simulating, the finished chunks are saved to the entry every
+# checkpoint_interval seconds and when the run is interrupted (e.g. Ctrl-C),
+# so a killed run resumes from its last save when called again. Chunks
+# finish in order, so the resumed counts equal those of an uninterrupted run.
+def simulate_cached(computer, num_simulated, seed=None, tolerances=None, max_workers=None,
+                    chunk_size=SIMULATION_CHUNK_SIZE, cache=None, checkpoint_interval=CHECKPOINT_INTERVAL):
+  cache = SimulationCache() if cache is None else cache
+  key = cache.key(computer, tolerances, seed, chunk_size)
+  entry = cache.load(key)
+
+  if entry is None:
+    entropy = np.random.SeedSequence(seed).entropy
+    done = 0
+    n_histograms = 1 if tolerances is None else len(tolerances)
+    histograms = [AlignmentHistogram() for _ in range(n_histograms)]
+  else:
+    entropy, done, histograms = entry
+
+  # simulate_parallel only adds the new simulations to the computer.
+  cached = [AlignmentHistogram(h.bins) for h in histograms]
+  if done < num_simulated:
+    first_chunk = -(-done // chunk_size)
+
+    # Bins of the chunks merged so far in this run.
+    latest = []
+    last_save = time.monotonic()
+    def save_progress(new_bins):
+      merged = [AlignmentHistogram(h.bins).add_bins(bins) for (h, bins) in zip(histograms, new_bins)]
+      cache.save(key, entropy, merged[0].total(), merged)
+      return merged[0].total()
+
+    def on_chunk(new):
+      nonlocal last_save
+      latest[:] = [h.bins.copy() for h in new]
+      if time.monotonic() - last_save >= checkpoint_interval:
+        save_progress(latest)
+        last_save = time.monotonic()
+
+    try:
+      new = computer.simulate_parallel(num_simulated - done, seed=entropy, tolerances=tolerances,
+                                       max_workers=max_workers, chunk_size=chunk_size,
+                                       first_chunk=first_chunk, on_chunk=on_chunk)
+    except KeyboardInterrupt:
+      if latest:
+        print(f'saved {save_progress(latest)} simulations to {cache.path(key)}')
+      raise
+    new = [new] if tolerances is None else new
+    for histogram, new_histogram in zip(histograms, new):
+      histogram.merge(new_histogram)
+    cache.save(key, entropy, num_simulated, histograms)
+  if tolerances is None:
+    computer.matches_histogram.merge(cached[0])
+
+  return histograms[0] if tolerances is None else histograms
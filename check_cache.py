@@ -0,0 +1,73 @@
+#!/usr/local/bin/python3
+import os
+import sys
+import tempfile
+import numpy as np
+from cache import simulation_key
+from checkpoint import Checkpoint, simulate_checkpointed
+from computer import Computer
+from geometry import AlignmentTarget, MarkerSet
+
+# Consistency check of the simulation cache keys: a change to anything that
+# determines the simulated counts must give a different key, or a cached
+# entry of another simulation is silently reused; for the same reason a
+# checkpoint must refuse to resume a simulation at another tolerance. The script prints a
+# line per failure and exits with status 1 if there is one.
+
+TOLERANCES = [0.5, 2.5]
+SEED = 0
+CHUNK_SIZE = 1000
+
+def make_computer(tolerance=TOLERANCES[0], azimuth=90.0, count_aligned_pair_only_once=False, planar_azimuths=False):
+  rng = np.random.default_rng(SEED)
+  x = rng.uniform(-400, 400, 10)
+  y = rng.uniform(-400, 400, 10)
+  markers = MarkerSet(x, y, y / 111000, x / 111000)
+  targets = [AlignmentTarget('Equinox', 'rise', azimuth), AlignmentTarget('Equinox', 'set', azimuth + 180)]
+  return Computer(markers, targets, tolerance, count_aligned_pair_only_once, planar_azimuths)
+
+# Pairs of (description, key) that must differ.
+def key_variants():
+  base = simulation_key(make_computer(), None, SEED, CHUNK_SIZE)
+  yield 'tolerance', base, simulation_key(make_computer(tolerance=TOLERANCES[1]), None, SEED, CHUNK_SIZE)
+  yield 'targets', base, simulation_key(make_computer(azimuth=91.0), None, SEED, CHUNK_SIZE)
+  yield 'pair counting', base, simulation_key(make_computer(count_aligned_pair_only_once=True), None, SEED, CHUNK_SIZE)
+  yield 'planar azimuths', base, simulation_key(make_computer(planar_azimuths=True), None, SEED, CHUNK_SIZE)
+  yield 'seed', base, simulation_key(make_computer(), None, SEED + 1, CHUNK_SIZE)
+  yield 'chunk size', base, simulation_key(make_computer(), None, SEED, CHUNK_SIZE + 1)
+  yield 'single tolerance vs list', base, simulation_key(make_computer(), TOLERANCES[:1], SEED, CHUNK_SIZE)
+  tolerance_list = simulation_key(make_computer(), TOLERANCES, SEED, CHUNK_SIZE)
+  yield 'tolerance order', tolerance_list, simulation_key(make_computer(), TOLERANCES[::-1], SEED, CHUNK_SIZE)
+
+def check_cache():
+  failures = []
+  for name, first, second in key_variants():
+    if first == second:
+      failures.append(f'changing the {name} does not change the cache key')
+  if simulation_key(make_computer(), None, SEED, CHUNK_SIZE) != simulation_key(make_computer(), None, SEED, CHUNK_SIZE):
+    failures.append('the cache key of one simulation is not stable')
+  return failures + check_checkpoint()
+
+def check_checkpoint():
+  with tempfile.TemporaryDirectory() as directory:
+    checkpoint = Checkpoint(os.path.join(directory, 'checkpoint.npz'))
+    simulate_checkpointed(make_computer(), 100, checkpoint, seed=SEED, progress=False)
+    try:
+      simulate_checkpointed(make_computer(tolerance=TOLERANCES[1]), 200, checkpoint, seed=SEED, progress=False)
+    except ValueError:
+      return []
+  return ['a checkpoint resumes a simulation at another tolerance']
+
+
+def main():
+  failures = check_cache()
+  if failures:
+    print('FAILED:')
+    for failure in failures:
+      print(f'  {failure}')
+    sys.exit(1)
+  print('all cache keys distinct, checkpoints checked')
+
+
+if __name__ == "__main__":
+  main()
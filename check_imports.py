@@ -0,0 +1,71 @@
+#!/usr/local/bin/python3
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Import-time check of the compute-only modules, which process pool
+# workers and the command lines load. Each module is imported in a fresh
+# interpreter after numpy, and must neither pull in any of HEAVY_MODULES
+# nor take longer than the budget (best of the repeats, in seconds). The
+# script prints a line per module and exits with status 1 on a failure.
+
+CORE_MODULES = ['utils', 'geometry', 'histogram', 'null_distribution', 'splitting', 'telemetry', 'projection',
+                'computer', 'cache', 'alignment_significance', 'batch']
+HEAVY_MODULES = ['bokeh', 'pandas', 'pyproj', 'plotly', 'scipy', 'openpyxl']
+IMPORT_TIME_BUDGET = 0.2
+REPEATS = 5
+
+MEASURE = '''
+import json, sys, time
+import numpy
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, sorted({{name.split('.')[0] for name in sys.modules}})]))
+'''
+
+# Best import time of module over repeats, and the top-level packages
+# loaded alongside it.
+def measure_import(module, repeats=REPEATS):
+  directory = os.path.dirname(os.path.abspath(__file__))
+  times = []
+  for _ in range(repeats):
+    output = subprocess.run([sys.executable, '-c', MEASURE.format(module=module)], cwd=directory,
+                            capture_output=True, text=True, check=True).stdout
+    elapsed, loaded = json.loads(output)
+    times.append(elapsed)
+  return min(times), loaded
+
+def check_imports(modules=CORE_MODULES, budget=IMPORT_TIME_BUDGET, repeats=REPEATS):
+  failures = []
+  for module in modules:
+    elapsed, loaded = measure_import(module, repeats)
+    heavy = [name for name in HEAVY_MODULES if name in loaded]
+    print(f'{module}: {1000 * elapsed:.1f} ms' + (f', loads {", ".join(heavy)}' if heavy else ''))
+    if heavy:
+      failures.append(f'{module} loads {", ".join(heavy)}')
+    if elapsed > budget:
+      failures.append(f'{module} takes {1000 * elapsed:.1f} ms to import (budget {1000 * budget:.0f} ms)')
+  return failures
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Check that the compute-only modules import quickly.')
+  parser.add_argument('modules', nargs='*', default=CORE_MODULES)
+  parser.add_argument('--budget', type=float, default=IMPORT_TIME_BUDGET, help='seconds per module')
+  parser.add_argument('--repeats', type=int, default=REPEATS)
+  args = parser.parse_args(argv)
+
+  failures = check_imports(args.modules, args.budget, args.repeats)
+  if failures:
+    print('FAILED:')
+    for failure in failures:
+      print(f'  {failure}')
+    sys.exit(1)
+  print('all imports within budget')
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,102 @@
+import json
+import os
+import time
+import numpy as np
+from cache import CHECKPOINT_INTERVAL, simulation_key
+from computer import progress_due
+from histogram import AlignmentHistogram, stack_bins, unstack_bins
+from utils import atomic_path
+
+# Checkpoint file of a single-process simulation: the counts so far, the
+# number of simulations and the state of the random number generator, so
+# that a resumed run draws exactly the numbers the original would have.
+# Written atomically, so a crash during a save leaves the previous
+# checkpoint intact. (simulate_cached checkpoints the parallel
+# simulation through its cache entry.)
+class Checkpoint:
+
+  def __init__(self, filename, interval=CHECKPOINT_INTERVAL):
+    self.filename = filename
+    self.interval = interval
+    self.last_save = time.monotonic()
+
+  def due(self):
+    return time.monotonic() - self.last_save >= self.interval
+
+  # Returns (key, num_simulated, histograms, rng state) or None if there is
+  # no checkpoint.
+  def load(self):
+    if not os.path.exists(self.filename):
+      return None
+    with np.load(self.filename) as entry:
+      return (str(entry['key']), int(entry['num_simulated']), unstack_bins(entry['bins']),
+              json.loads(str(entry['rng_state'])))
+
+  def save(self, key, num_simulated, histograms, rng_state):
+    directory = os.path.dirname(self.filename)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    with atomic_path(self.filename) as temporary:
+      np.savez(temporary, key=key, num_simulated=num_simulated, bins=stack_bins(histograms),
+               rng_state=json.dumps(rng_state))
+    self.last_save = time.monotonic()
+
+# Computer.simulated_counts with checkpoints: simulates num_simulated random
+# marker sets from np.random.default_rng(seed), at computer.tolerance or at
+# each of tolerances, saving to checkpoint after a batch whenever its
+# interval has passed, at the end, and when interrupted (e.g. Ctrl-C). If
+# the checkpoint already holds part of the same simulation (same markers,
+# targets, tolerances, options, seed and batch size) the run continues from
+# it, and a checkpoint of any other simulation raises ValueError. One
+# holding num_simulated or more is returned as is, and a larger
+# num_simulated in a later call extends it. Resumed counts are identical to
+# those of an uninterrupted run, and so are those of an extended one if the
+# earlier num_simulated was a multiple of the batch size. Like
+# simulate_parallel, returns the histogram, also merged into
+# computer.matches_histogram, or with tolerances one histogram per
+# tolerance.
+def simulate_checkpointed(computer, num_simulated, checkpoint, seed=None, tolerances=None, batch_size=None,
+                          progress=True):
+  if batch_size is None:
+    batch_size = computer.default_batch_size()
+  key = simulation_key(computer, tolerances, seed, batch_size)
+  rng = np.random.default_rng(seed)
+  n_histograms = 1 if tolerances is None else len(tolerances)
+  histograms = [AlignmentHistogram() for _ in range(n_histograms)]
+  done = 0
+
+  entry = checkpoint.load()
+  if entry is not None:
+    entry_key, done, histograms, rng_state = entry
+    if entry_key != key:
+      raise ValueError(f'{checkpoint.filename} holds a different simulation: the markers, targets, tolerances, '
+                       f'counting options, seed or batch size differ')
+    rng.bit_generator.state = rng_state
+    print(f'resuming from {done} simulations in {checkpoint.filename}')
+
+  # State after the last complete batch, which is what gets saved.
+  def state(done):
+    return done, [AlignmentHistogram(h.bins) for h in histograms], rng.bit_generator.state
+
+  saved = state(done)
+  try:
+    for start, stop, _, counts in computer.simulated_batches(max(num_simulated - done, 0), tolerances, rng=rng,
+                                                         batch_size=batch_size, progress=False):
+      counts = np.reshape(counts, (len(counts), -1))
+      for k, histogram in enumerate(histograms):
+        histogram.add(counts[:, k])
+      saved = state(done + stop)
+      if checkpoint.due():
+        checkpoint.save(key, *saved)
+      if progress and progress_due(done + start, done + stop, num_simulated):
+        print(f'iteration {done + stop} / {num_simulated}')
+  except KeyboardInterrupt:
+    checkpoint.save(key, *saved)
+    print(f'saved {saved[0]} simulations to {checkpoint.filename}')
+    raise
+
+  checkpoint.save(key, *saved)
+  if tolerances is not None:
+    return histograms
+  computer.matches_histogram.merge(histograms[0])
+  return histograms[0]
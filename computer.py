@@ -1,7 +1,29 @@
 import numpy as np
-import bisect
-from pyproj import Transformer
-from geometry import Marker, PairOfMarkers, Match
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import repeat
+from geometry import MarkerSet, MatchSet, PairOfMarkers, azimuth_matrix, planar_azimuth_matrix
+from projection import web_mercator_to_lat_lon
+from null_distribution import NullDistribution
+from splitting import SplittingEstimator
+from histogram import AlignmentHistogram
+from telemetry import NULL_TELEMETRY
+from utils import angular_difference
+
+# Upper bound on the number of pair/target entries scored at once
+# by Computer.simulate.
+SIMULATION_BATCH_ELEMENTS = 2 ** 24
+
+# Number of simulations per independently seeded task in
+# Computer.simulate_parallel.
+SIMULATION_CHUNK_SIZE = 10000
+
+# Simulation progress is printed each time the number of iterations passes
+# a multiple of PROGRESS_INTERVAL, and at the end.
+PROGRESS_INTERVAL = 1000
+
+def progress_due(start, stop, total):
+  return stop == total or stop // PROGRESS_INTERVAL > start // PROGRESS_INTERVAL
 
 def compute_all_azimuths(markers):
   pairs = []
@@ -15,99 +37,544 @@ def compute_all_azimuths(markers):
 
   return pairs
 
+# Azimuths of all ordered pairs of distinct markers as a flat array, in
+# the same order as compute_all_azimuths but without building pairs.
+def pair_azimuths(markers):
+  lat, lon = marker_coordinates(markers)
+  azimuths = azimuth_matrix(lat, lon)
+  return azimuths[~np.eye(len(lat), dtype=bool)]
+
+def marker_coordinates(markers):
+  marker_set = MarkerSet.from_markers(markers)
+  return marker_set.lat, marker_set.lon
+
+# Boolean mask of shape (..., N, N, T) that is True where the azimuth of
+# ordered pair (i, j) is within tolerance of target t. Self-pairs are never
+# aligned. With start and stop, only rows i in [start, stop) are built,
+# giving shape (..., stop - start, N, T), so a large catalog can be scanned
+# in blocks of rows.
+def alignment_mask(azimuths, target_azimuths, tolerance, start=0, stop=None):
+  n_markers = azimuths.shape[-1]
+  stop = n_markers if stop is None else min(stop, n_markers)
+  mask = angular_difference(azimuths[..., start:stop, :, None], target_azimuths) < tolerance
+  rows = np.arange(start, stop)
+  mask[..., rows - start, rows, :] = False
+  return mask
+
+# Number of rows of an (N, N, T) alignment mask per block, so that a block
+# for each of n_sets marker sets stays around SIMULATION_BATCH_ELEMENTS
+# entries.
+def mask_block_rows(n_markers, n_targets, n_sets=1):
+  return max(1, SIMULATION_BATCH_ELEMENTS // max(n_sets * n_markers * n_targets, 1))
+
+# Number of alignments in each marker set of a (..., N, N, T) mask. When
+# counting each pair only once, (i, j) and (j, i) matching any target
+# together contribute a single alignment.
+def count_mask_alignments(mask, count_aligned_pair_only_once=False):
+  if not count_aligned_pair_only_once:
+    return np.count_nonzero(mask, axis=(-3, -2, -1))
+
+  return count_aligned_pairs(mask.any(axis=-1))
+
+# Number of unordered pairs {i, j} with aligned[..., i, j] or
+# aligned[..., j, i], for boolean arrays of shape (..., N, N).
+def count_aligned_pairs(aligned):
+  n_markers = aligned.shape[-1]
+  aligned = aligned | np.swapaxes(aligned, -1, -2)
+  upper = np.triu(np.ones((n_markers, n_markers), dtype=bool), k=1)
+  return np.count_nonzero(aligned & upper, axis=(-2, -1))
+
+# Dedup an (i, j, target index) array to the first match of every
+# unordered pair.
+def unique_pair_indices(indices, n_markers):
+  if len(indices) == 0:
+    return indices
+  ends = np.sort(indices[:, :2], axis=1)
+  _, first = np.unique(ends[:, 0] * n_markers + ends[:, 1], return_index=True)
+  return indices[np.sort(first)]
+
+# For each marker, the bearings to every other marker in sorted order, so
+# that the partners aligned with a target are found by binary search in the
+# window [target - tolerance, target + tolerance] rather than by testing
+# all N^2 pairs. Building the index is O(N^2 log N); a query costs
+# O(N T log N) plus the number of matches. Querying a block of rows at a
+# time keeps the candidates in memory proportional to the block.
+class BearingIndex:
+
+  # Rows are laid out ROW_STRIDE degrees apart in one flat sorted array,
+  # so every row can be searched with a single np.searchsorted call.
+  ROW_STRIDE = 720.0
+
+  # Slack (degrees) on the search window, at least a few ulps of the
+  # largest row offset, ROW_STRIDE * N, since adding the offsets rounds the
+  # bearings and window bounds to that precision. Candidates are confirmed
+  # with the same comparison as alignment_mask, so results match it exactly.
+  WINDOW_SLACK = 1e-9
+
+  def __init__(self, azimuths):
+    self.azimuths = azimuths
+    n_markers = azimuths.shape[0]
+    off_diagonal = ~np.eye(n_markers, dtype=bool)
+    bearings = np.reshape(azimuths[off_diagonal], (n_markers, n_markers - 1))
+    del off_diagonal
+    # Partner k of marker i is k, or k + 1 once past i.
+    columns = np.arange(n_markers - 1, dtype=np.int32)
+    partners = columns + (columns >= np.arange(n_markers, dtype=np.int32)[:, None])
+
+    order = np.argsort(bearings, axis=1)
+    offsets = self.ROW_STRIDE * np.arange(n_markers)[:, None]
+    self.sorted_bearings = (np.take_along_axis(bearings, order, axis=1) + offsets).ravel()
+    self.partners = np.take_along_axis(partners, order, axis=1).ravel()
+    self.n_markers = n_markers
+    self.window_slack = max(self.WINDOW_SLACK, 4 * float(np.spacing(self.ROW_STRIDE * n_markers)))
+
+  # Indices (i, j, target index) of all ordered pairs whose bearing is
+  # within tolerance of a target, ordered by i, then j, then target. With
+  # start and stop, only pairs with i in [start, stop) are returned.
+  def query(self, target_azimuths, tolerance, start=0, stop=None):
+    target_azimuths = np.asarray(target_azimuths, dtype=np.float64)
+    stop = self.n_markers if stop is None else min(stop, self.n_markers)
+    rows = np.arange(start, stop)
+
+    # Windows crossing 0/360 are searched again shifted by a full turn;
+    # every window is clipped to the row so it cannot spill into the next.
+    low = target_azimuths - tolerance - self.window_slack
+    high = target_azimuths + tolerance + self.window_slack
+    shifts = np.array([-360.0, 0.0, 360.0])
+    low = np.clip(low[:, None] + shifts, -1.0, 361.0)
+    high = np.clip(high[:, None] + shifts, -1.0, 361.0)
+
+    offsets = self.ROW_STRIDE * rows[:, None, None]
+    starts = np.searchsorted(self.sorted_bearings, (offsets + low).ravel(), side='left')
+    stops = np.searchsorted(self.sorted_bearings, (offsets + high).ravel(), side='right')
+    lengths = np.maximum(stops - starts, 0)
+
+    # Expand the [start, stop) ranges into candidate positions.
+    n_windows_per_row = len(target_azimuths) * len(shifts)
+    window_rows = np.repeat(rows, n_windows_per_row)
+    window_targets = np.tile(np.repeat(np.arange(len(target_azimuths)), len(shifts)), len(rows))
+    total = int(lengths.sum())
+    range_starts = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    positions = range_starts + np.arange(total)
+
+    i = np.repeat(window_rows, lengths)
+    j = self.partners[positions]
+    t = np.repeat(window_targets, lengths)
+
+    aligned = angular_difference(self.azimuths[i, j], target_azimuths[t]) < tolerance
+    indices = np.stack([i[aligned], j[aligned], t[aligned]], axis=1)
+
+    keys = (indices[:, 0] * self.n_markers + indices[:, 1]) * len(target_azimuths) + indices[:, 2]
+    _, unique = np.unique(keys, return_index=True)
+    return indices[unique]
+
+def markers_from_coordinates(x, y, lat, lon):
+  return MarkerSet(x, y, lat, lon)
+
+# Angular distances whose count below a tolerance equals the alignment
+# count at that tolerance, one row of shape (..., K) per marker set. Without
+# pair deduplication there is one distance per ordered pair and target;
+# otherwise one per unordered pair, the smallest over both directions and
+# all targets.
+def alignment_distances(azimuths, target_azimuths, count_aligned_pair_only_once=False):
+  n_markers = azimuths.shape[-1]
+  distances = angular_difference(azimuths[..., None], target_azimuths)
+
+  if not count_aligned_pair_only_once:
+    i, j = np.nonzero(~np.eye(n_markers, dtype=bool))
+    return np.reshape(distances[..., i, j, :], distances.shape[:-3] + (-1,))
+
+  distances = distances.min(axis=-1)
+  distances = np.minimum(distances, np.swapaxes(distances, -1, -2))
+  i, j = np.triu_indices(n_markers, k=1)
+  return distances[..., i, j]
+
+# Alignment counts at each tolerance from the rows of alignment_distances,
+# as an integer array of shape (..., len(tolerances)). Each distance is
+# binned once against the sorted tolerances and the bins accumulated.
+def count_distances_by_tolerance(distances, tolerances):
+  tolerances = np.asarray(tolerances, dtype=np.float64)
+  order = np.argsort(tolerances)
+  n_tolerances = len(tolerances)
+  rows = np.reshape(distances, (-1, distances.shape[-1]))
+
+  # A distance d is an alignment at every tolerance above it, i.e. at the
+  # sorted tolerances from index searchsorted(d, side='right') onwards.
+  bins = np.searchsorted(tolerances[order], rows, side='right')
+  bins += (n_tolerances + 1) * np.arange(len(rows))[:, None]
+  hist = np.bincount(bins.ravel(), minlength=len(rows) * (n_tolerances + 1))
+  counts_sorted = np.cumsum(np.reshape(hist, (len(rows), n_tolerances + 1)), axis=1)[:, :n_tolerances]
+
+  counts = np.empty_like(counts_sorted)
+  counts[:, order] = counts_sorted
+  return np.reshape(counts, distances.shape[:-1] + (n_tolerances,))
+
+# Process pool task for Computer.simulate_parallel.
+def simulate_chunk(computer, num_simulated, seed_sequence, tolerances=None):
+  rng = np.random.default_rng(seed_sequence)
+  counts, _ = computer.simulated_counts(num_simulated, tolerances=tolerances, rng=rng, progress=False)
+  counts = np.reshape(counts, (num_simulated, -1))
+  return [AlignmentHistogram().add(counts[:, k]) for k in range(counts.shape[1])]
+
+# simulate_chunk that also returns the stage times and counters the
+# worker's copy of the computer's telemetry collected.
+def simulate_chunk_instrumented(computer, num_simulated, seed_sequence, tolerances=None):
+  histograms = simulate_chunk(computer, num_simulated, seed_sequence, tolerances)
+  return histograms, computer.telemetry.snapshot()
+
 class Computer:
-  def __init__(self, markers, alignment_targets, tolerance, count_aligned_pair_only_once=False):
+  # With planar_azimuths, simulated marker sets are scored on azimuths
+  # computed directly from their x/y (see planar_azimuth_matrix) instead of
+  # geodesic azimuths from lat/lon. Observed markers always use lat/lon.
+  # Simulations report stage timings and progress to telemetry (see
+  # telemetry.Telemetry) if given.
+  def __init__(self, markers, alignment_targets, tolerance, count_aligned_pair_only_once=False,
+               planar_azimuths=False, telemetry=None):
     self.markers = markers
+    self.marker_set = MarkerSet.from_markers(markers)
     self.alignment_targets = alignment_targets
     self.tolerance = tolerance
     self.count_aligned_pair_only_once = count_aligned_pair_only_once
-    self.matches_list = []
+    self.planar_azimuths = planar_azimuths
+    self.target_azimuths = np.array([a.azimuth for a in alignment_targets], dtype=np.float64)
+    self.matches_histogram = AlignmentHistogram()
+    self.null_distribution = None
+    self.telemetry = NULL_TELEMETRY if telemetry is None else telemetry
 
   def determine_xy_center_and_radius(self):
-    n_markers = len(self.markers)
-    center_x = 0
-    center_y = 0
-    for i in range(n_markers):
-      m = self.markers[i]
-      center_x += m.x
-      center_y += m.y
-
-    center_x /= n_markers
-    center_y /= n_markers
-
-    rad = 0
-    for i in range(n_markers):
-      m = self.markers[i]
-      r = np.sqrt((m.x - center_x) ** 2 + (m.y - center_y) ** 2)
-      rad = rad if rad > r else r
-
+    center_x = np.mean(self.marker_set.x)
+    center_y = np.mean(self.marker_set.y)
+    rad = np.max(np.sqrt((self.marker_set.x - center_x) ** 2 + (self.marker_set.y - center_y) ** 2))
     return center_x, center_y, rad
 
-  def random_markers(self):
-    n_markers = len(self.markers)
-    center_x, center_y, rad0 = self.determine_xy_center_and_radius()
-    r2 = np.random.uniform(0, rad0 ** 2, size=n_markers)
-    angle = np.pi * np.random.uniform(0, 2, size=n_markers)
-    r = np.apply_along_axis(np.sqrt, 0, r2)
-    cos = np.apply_along_axis(np.cos, 0, angle)
-    sin = np.apply_along_axis(np.sin, 0, angle)
-    x = np.multiply(r, cos) + center_x
-    y = np.multiply(r, sin) + center_y
+  # Draw n_sets sets of uniformly distributed points in the disc around the
+  # markers. Returns x, y, lat and lon arrays of shape (n_sets, N). rng is a
+  # np.random.Generator, or None for the global np.random state.
+  def random_marker_coordinates(self, n_sets, rng=None):
+    x, y = self.random_marker_xy(n_sets, rng)
+    lat, lon = web_mercator_to_lat_lon(x, y)
+    return x, y, lat, lon
 
-    transformer = Transformer.from_crs("epsg:3857", "epsg:4326")
-    lat, lon = transformer.transform(x, y)
+  def random_marker_xy(self, n_sets, rng=None):
+    return self.random_disc_xy((n_sets, len(self.markers)), rng)
 
-    names = [f'Random {i}' for i in range(n_markers)]
+  # Uniformly distributed x/y points in the disc around the markers.
+  def random_disc_xy(self, shape, rng=None):
+    rng = np.random if rng is None else rng
+    center_x, center_y, rad0 = self.determine_xy_center_and_radius()
+    r2 = rng.uniform(0, rad0 ** 2, size=shape)
+    angle = np.pi * rng.uniform(0, 2, size=shape)
+    r = np.sqrt(r2)
+    x = r * np.cos(angle) + center_x
+    y = r * np.sin(angle) + center_y
+    return x, y
 
-    markers = [Marker(x0, y0, lat0, lon0, names0) for (x0, y0, lat0, lon0, names0) in zip(x, y, lat, lon, names)]
-    return markers
+  def random_markers(self, rng=None):
+    x, y, lat, lon = self.random_marker_coordinates(1, rng)
+    return markers_from_coordinates(x[0], y[0], lat[0], lon[0])
 
-  def determine_alignments(self, markers):
-    n_markers = len(markers)
-    matches = []
-    for i in range(n_markers):
-      for j in range(n_markers):
-        if j == i:
-          continue
+  # n_sets copies of the observed markers, each moved by an independent
+  # Gaussian displacement whose standard deviation along each ground axis is
+  # error_scale times the marker's stated error in metres (markers without
+  # one stay put). Ground metres are stretched by 1 / cos(lat) in Web
+  # Mercator. Returns x, y, lat and lon arrays of shape (n_sets, N).
+  def perturbed_marker_coordinates(self, n_sets, rng=None, error_scale=1.0):
+    rng = np.random if rng is None else rng
+    errors = self.marker_set.errors
+    if errors is None:
+      errors = np.zeros(len(self.marker_set))
+    sigma = error_scale * np.nan_to_num(errors) / np.cos(np.radians(self.marker_set.lat))
+    x = self.marker_set.x + sigma * rng.standard_normal((n_sets, len(sigma)))
+    y = self.marker_set.y + sigma * rng.standard_normal((n_sets, len(sigma)))
+    lat, lon = web_mercator_to_lat_lon(x, y)
+    return x, y, lat, lon
+
+  # Observed alignment counts of num_copies perturbed copies of the markers
+  # (see perturbed_marker_coordinates), at self.tolerance (shape
+  # (num_copies,)) or at each of tolerances (shape (num_copies,
+  # len(tolerances))). Copies are scored in batches like simulations, on
+  # geodesic azimuths as for the observed markers.
+  def perturbed_counts(self, num_copies, tolerances=None, rng=None, batch_size=None, error_scale=1.0):
+    if batch_size is None:
+      batch_size = self.default_batch_size()
 
-        pair = PairOfMarkers(markers[i], markers[j])
+    shape = (num_copies,) if tolerances is None else (num_copies, len(tolerances))
+    counts = np.empty(shape, dtype=np.int64)
+    for start in range(0, num_copies, batch_size):
+      stop = min(start + batch_size, num_copies)
+      _, _, lat, lon = self.perturbed_marker_coordinates(stop - start, rng, error_scale)
+      counts[start:stop] = self.count_azimuth_alignments(azimuth_matrix(lat, lon), tolerances)
+    return counts
 
-        for a in self.alignment_targets:
-          if np.abs(pair.azimuth - a.azimuth) < self.tolerance:
-            matches.append(Match(pair, a))
+  # Indices (i, j, target index) of all alignments among markers given by
+  # lat/lon arrays, as an integer array of shape (n_matches, 3) ordered by
+  # i, then j, then target. When counting each pair only once, the first
+  # match of every unordered pair is kept.
+  def alignment_indices(self, lat, lon):
+    azimuths = azimuth_matrix(lat, lon)
+    n_markers = azimuths.shape[0]
+    blocks = [np.empty((0, 3), dtype=np.int64)]
+    if n_markers > 1:
+      # Query in blocks of rows so memory does not grow as N^2 T.
+      index = BearingIndex(azimuths)
+      block = mask_block_rows(n_markers, len(self.target_azimuths))
+      for start in range(0, n_markers, block):
+        blocks.append(index.query(self.target_azimuths, self.tolerance, start, start + block))
+    indices = np.concatenate(blocks)
 
     # Reduce alignment count to only count pairs once if requested.
-    match_map = {}
     if self.count_aligned_pair_only_once:
-      for m in matches:
-        if m.unique_pair() not in match_map:
-          match_map[m.unique_pair()] = m
-      matches = match_map.values()
+      indices = unique_pair_indices(indices, n_markers)
+
+    return indices
+
+  # Number of alignments for a batch of marker sets given by lat/lon
+  # arrays of shape (..., N).
+  def count_alignments(self, lat, lon):
+    return self.count_azimuth_alignments(azimuth_matrix(lat, lon))
+
+  # Number of alignments for a batch of simulated marker sets given by
+  # Web Mercator x/y arrays of shape (..., N), honouring planar_azimuths.
+  def count_xy_alignments(self, x, y, tolerances=None):
+    if self.planar_azimuths:
+      with self.telemetry.stage('azimuths'):
+        azimuths = planar_azimuth_matrix(x, y)
+    else:
+      with self.telemetry.stage('projection'):
+        lat, lon = web_mercator_to_lat_lon(x, y)
+      with self.telemetry.stage('azimuths'):
+        azimuths = azimuth_matrix(lat, lon)
+    return self.count_azimuth_alignments(azimuths, tolerances)
+
+  # Number of alignments for a batch of azimuth matrices of shape
+  # (..., N, N), at self.tolerance or, if given, at each of tolerances.
+  # The 'counting' stage includes the pair deduplication. A batch whose mask
+  # would exceed SIMULATION_BATCH_ELEMENTS even for a single marker set is
+  # scored in blocks of rows (see count_azimuth_alignments_blocked).
+  def count_azimuth_alignments(self, azimuths, tolerances=None):
+    n_markers = azimuths.shape[-1]
+    n_sets = azimuths.size // max(n_markers * n_markers, 1)
+    block = mask_block_rows(n_markers, len(self.target_azimuths), n_sets)
+    if block < n_markers:
+      return self.count_azimuth_alignments_blocked(azimuths, tolerances, block)
+
+    if tolerances is None:
+      with self.telemetry.stage('matching'):
+        mask = alignment_mask(azimuths, self.target_azimuths, self.tolerance)
+      with self.telemetry.stage('counting'):
+        return count_mask_alignments(mask, self.count_aligned_pair_only_once)
+
+    with self.telemetry.stage('matching'):
+      distances = alignment_distances(azimuths, self.target_azimuths, self.count_aligned_pair_only_once)
+    with self.telemetry.stage('counting'):
+      return count_distances_by_tolerance(distances, tolerances)
+
+  # count_azimuth_alignments over blocks of block rows of the (..., N, N, T)
+  # angular distances, with self-pairs at infinity so they never align.
+  # Counts of ordered pairs are accumulated block by block. When counting
+  # each pair only once, the smallest distance of every ordered pair is kept
+  # instead, an (..., N, N) array, and both directions combined at the end.
+  def count_azimuth_alignments_blocked(self, azimuths, tolerances, block):
+    n_markers = azimuths.shape[-1]
+    leading = azimuths.shape[:-2]
+    if self.count_aligned_pair_only_once:
+      nearest = np.empty(azimuths.shape)
+    else:
+      counts = np.zeros(leading if tolerances is None else leading + (len(tolerances),), dtype=np.int64)
+
+    for start in range(0, n_markers, block):
+      stop = min(start + block, n_markers)
+      with self.telemetry.stage('matching'):
+        distances = angular_difference(azimuths[..., start:stop, :, None], self.target_azimuths)
+        rows = np.arange(start, stop)
+        distances[..., rows - start, rows, :] = np.inf
+      with self.telemetry.stage('counting'):
+        if self.count_aligned_pair_only_once:
+          nearest[..., start:stop, :] = distances.min(axis=-1)
+        elif tolerances is None:
+          counts += np.count_nonzero(distances < self.tolerance, axis=(-3, -2, -1))
+        else:
+          counts += count_distances_by_tolerance(np.reshape(distances, leading + (-1,)), tolerances)
+
+    if not self.count_aligned_pair_only_once:
+      return counts
+    with self.telemetry.stage('counting'):
+      nearest = np.minimum(nearest, np.swapaxes(nearest, -1, -2))
+      i, j = np.triu_indices(n_markers, k=1)
+      if tolerances is None:
+        return np.count_nonzero(nearest[..., i, j] < self.tolerance, axis=-1)
+      return count_distances_by_tolerance(nearest[..., i, j], tolerances)
 
-    return matches
+  # Number of alignments among the markers at self.tolerance for many sets
+  # of target azimuths at once. target_table has shape (..., T) and the
+  # result its leading shape; nan targets never match. The bearings are
+  # computed once and the table is scored in chunks of rows, each scanned in
+  # blocks of marker rows, so the mask stays around SIMULATION_BATCH_ELEMENTS
+  # entries however large the catalog.
+  def count_alignments_for_targets(self, target_table):
+    target_table = np.asarray(target_table, dtype=np.float64)
+    rows = np.reshape(target_table, (-1, target_table.shape[-1]))
+    azimuths = azimuth_matrix(self.marker_set.lat, self.marker_set.lon)
+    n_markers = azimuths.shape[0]
+    block = min(mask_block_rows(n_markers, rows.shape[1]), max(n_markers, 1))
+    chunk = max(1, SIMULATION_BATCH_ELEMENTS // max(block * n_markers * rows.shape[1], 1))
 
-  def simulate(self, num_simulated, num_examples):
+    counts = np.zeros(len(rows), dtype=np.int64)
+    for start in range(0, len(rows), chunk):
+      targets = rows[start:start + chunk, None, None, :]
+      if self.count_aligned_pair_only_once:
+        aligned = np.zeros((len(targets), n_markers, n_markers), dtype=bool)
+      for row_start in range(0, n_markers, block):
+        mask = alignment_mask(azimuths, targets, self.tolerance, row_start, row_start + block)
+        if self.count_aligned_pair_only_once:
+          aligned[:, row_start:row_start + block] = mask.any(axis=-1)
+        else:
+          counts[start:start + chunk] += np.count_nonzero(mask, axis=(-3, -2, -1))
+      if self.count_aligned_pair_only_once:
+        counts[start:start + chunk] = count_aligned_pairs(aligned)
+    return np.reshape(counts, target_table.shape[:-1])
+
+  # Alignments among markers (a list of Marker or a MarkerSet) as a
+  # MatchSet, deduplicated by unique_pair_indices when counting each pair
+  # only once. Pair objects are only built when the graphers iterate it.
+  def determine_alignments(self, markers):
+    marker_set = MarkerSet.from_markers(markers)
+    indices = self.alignment_indices(marker_set.lat, marker_set.lon)
+    return MatchSet.from_indices(marker_set, self.alignment_targets, indices)
+
+  # Number of marker sets scored per batch so that the (batch, N, N, T)
+  # alignment mask stays around SIMULATION_BATCH_ELEMENTS entries.
+  def default_batch_size(self):
+    n_markers = len(self.markers)
+    per_set = n_markers * n_markers * max(len(self.alignment_targets), 1)
+    return max(1, SIMULATION_BATCH_ELEMENTS // per_set)
+
+  # Alignment counts of num_simulated random marker sets, either at
+  # self.tolerance (shape (num_simulated,)) or at each of tolerances (shape
+  # (num_simulated, len(tolerances))), along with the first num_examples
+  # simulated marker sets.
+  def simulated_counts(self, num_simulated, tolerances=None, num_examples=0,
+                       rng=None, batch_size=None, progress=True):
+    examples = []
+    shape = (num_simulated,) if tolerances is None else (num_simulated, len(tolerances))
+    counts = np.empty(shape, dtype=np.int64)
+    for start, stop, batch_examples, batch_counts in self.simulated_batches(num_simulated, tolerances, num_examples,
+                                                                            rng, batch_size, progress):
+      examples.extend(batch_examples)
+      counts[start:stop] = batch_counts
+
+    return counts, examples
+
+  # Generator behind simulated_counts that yields, per batch, the range of
+  # simulations covered, the examples drawn from it and its counts.
+  def simulated_batches(self, num_simulated, tolerances=None, num_examples=0,
+                        rng=None, batch_size=None, progress=True):
+    if batch_size is None:
+      batch_size = self.default_batch_size()
+
+    for start in range(0, num_simulated, batch_size):
+      stop = min(start + batch_size, num_simulated)
+      with self.telemetry.stage('rng'):
+        x, y = self.random_marker_xy(stop - start, rng)
+      examples = []
+      for k in range(min(num_examples - start, stop - start)):
+        lat, lon = web_mercator_to_lat_lon(x[k], y[k])
+        examples.append(markers_from_coordinates(x[k], y[k], lat, lon))
+      counts = self.count_xy_alignments(x, y, tolerances)
+      if self.telemetry.enabled:
+        # Matches at the largest tolerance, which has the most.
+        self.telemetry.count('iterations', stop - start)
+        self.telemetry.count('matches', int(np.reshape(counts, (stop - start, -1)).max(axis=1).sum()))
+        if progress:
+          self.telemetry.progress(stop, num_simulated)
+      if progress and progress_due(start, stop, num_simulated):
+        print(f'iteration {stop} / {num_simulated}')
+      yield start, stop, examples, counts
+
+  # Simulate num_simulated random marker sets at self.tolerance, adding their
+  # counts to self.matches_histogram one batch at a time. Returns the first
+  # num_examples simulated marker sets.
+  def simulate(self, num_simulated, num_examples, batch_size=None, rng=None):
     examples = []
-    for i in range(num_simulated):
-      markers = self.random_markers()
-      if len(examples) < num_examples:
-        examples.append(markers)
-      matches = self.determine_alignments(markers)
-      num_matches = len(matches)
-      self.matches_list.append(num_matches)
-      if (i + 1) % 1000 == 0:
-        print(f'iteration {i + 1} / {num_simulated}')
-    self.matches_list.sort()
+    for _, _, batch_examples, counts in self.simulated_batches(num_simulated,
+                                                                num_examples=num_examples,
+                                                                rng=rng,
+                                                                batch_size=batch_size):
+      examples.extend(batch_examples)
+      self.matches_histogram.add(counts)
     return examples
 
+  # Run the simulation in a process pool. num_simulated is split into
+  # chunks of chunk_size, and chunk k draws from its own Generator seeded by
+  # the k-th child of SeedSequence(seed), so a fixed seed gives the same
+  # counts for any number of workers. Passing first_chunk continues the
+  # sequence of children, to extend an earlier run with the same seed. Each
+  # chunk is reduced to histograms before it is returned. Without
+  # tolerances, returns the histogram of this run and merges it into
+  # self.matches_histogram; with tolerances, returns one histogram per
+  # tolerance. on_chunk, if given, is called with the list of histograms
+  # so far after each chunk is merged, in chunk order. max_workers=0 runs
+  # the chunks one after another in this process instead, with the same
+  # counts, so that a profiler or tracemalloc there sees the simulation.
+  def simulate_parallel(self, num_simulated, seed=None, tolerances=None,
+                        max_workers=None, chunk_size=SIMULATION_CHUNK_SIZE, first_chunk=0, on_chunk=None):
+    chunks = [min(chunk_size, num_simulated - start) for start in range(0, num_simulated, chunk_size)]
+    entropy = np.random.SeedSequence(seed).entropy
+    seeds = [np.random.SeedSequence(entropy, spawn_key=(k,)) for k in range(first_chunk, first_chunk + len(chunks))]
+
+    n_histograms = 1 if tolerances is None else len(tolerances)
+    histograms = [AlignmentHistogram() for _ in range(n_histograms)]
+    # Workers send back what their copy of the telemetry collected; chunks
+    # run in this process record into self.telemetry directly.
+    in_process = max_workers == 0
+    instrumented = self.telemetry.enabled and not in_process
+    task = simulate_chunk_instrumented if instrumented else simulate_chunk
+    with nullcontext() if in_process else ProcessPoolExecutor(max_workers=max_workers) as executor:
+      run = map if in_process else executor.map
+      for result in run(task, repeat(self), chunks, seeds, repeat(tolerances)):
+        if instrumented:
+          result, (stage_times, counters) = result
+          self.telemetry.merge(stage_times, counters)
+        for histogram, chunk_histogram in zip(histograms, result):
+          histogram.merge(chunk_histogram)
+        if on_chunk is not None:
+          on_chunk(histograms)
+        self.telemetry.progress(histograms[0].total(), num_simulated)
+        print(f'iteration {histograms[0].total()} / {num_simulated}')
+
+    if tolerances is None:
+      self.matches_histogram.merge(histograms[0])
+      return histograms[0]
+    return histograms
+
+  # Number of alignments at each tolerance for marker sets given by lat/lon
+  # arrays of shape (..., N).
+  def count_alignments_by_tolerance(self, lat, lon, tolerances):
+    return self.count_azimuth_alignments(azimuth_matrix(lat, lon), tolerances)
+
+  # Use the semi-analytic null distribution (see null_distribution) in
+  # report_significance instead of the simulated matches_histogram.
+  def compute_null_distribution(self, method='moment'):
+    self.null_distribution = NullDistribution(len(self.markers), self.target_azimuths, self.tolerance,
+                                              self.count_aligned_pair_only_once, method)
+    return self.null_distribution
+
+  # Estimate the p-value of an observed count far in the tail by adaptive
+  # multilevel splitting (see splitting). Returns the estimate and its
+  # standard error.
+  def tail_significance(self, observed_alignments, seed=None, relative_error=0.1,
+                        n_particles=1000, max_runs=100):
+    estimator = SplittingEstimator(self, n_particles=n_particles)
+    return estimator.p_value(observed_alignments, seed=seed, relative_error=relative_error, max_runs=max_runs)
+
   def report_significance(self, observed_alignments=0):
 
-    i_left = bisect.bisect_left(self.matches_list, observed_alignments)
-    i_right = bisect.bisect_right(self.matches_list, observed_alignments)
-    v = 0.5 * (float(i_left) + float(i_right))
-    significance = 1 - v / len(self.matches_list)
+    if self.null_distribution is not None:
+      significance = self.null_distribution.p_value(observed_alignments)
+    else:
+      significance = self.matches_histogram.p_value(observed_alignments)
     print(
-      f'The p-value for {observed_alignments} alignments on {self.n_markers} markers is {significance:.5f} (angle tolerance {self.tolerance} deg)')
+      f'The p-value for {observed_alignments} alignments on {len(self.markers)} markers is {significance:.5f} (angle tolerance {self.tolerance} deg)')
     return significance
 
 
@@ -0,0 +1,213 @@
+#!/usr/local/bin/python3
+import argparse
+import threading
+import time
+import numpy as np
+from bokeh.layouts import column, row
+from bokeh.models import Band, Button, CheckboxGroup, ColumnDataSource, Div, Range1d, Select, Span
+from bokeh.plotting import curdoc, figure
+from alignment_significance import ALIGNMENT_TARGETS, DATA_FILE, SEED, TOLERANCES
+from computer import Computer, marker_coordinates
+from histogram import AlignmentHistogram
+from reader import DataReader
+
+# Live view of a running simulation, served by bokeh:
+#   bokeh serve dashboard.py        or        python dashboard.py
+# A background thread simulates marker sets in batches and adds their
+# counts at every tolerance to one histogram per tolerance. The page never
+# waits for it: every UPDATE_INTERVAL ms a periodic callback copies the
+# histograms and updates the figures, streaming new rows and patching
+# existing ones, so plotting costs the simulation nothing but the copy.
+# Switching tolerance only changes which histogram is shown; changing the
+# targets restarts the simulation.
+
+UPDATE_INTERVAL = 1000
+BATCH_SIZE = 2000
+CONFIDENCE_Z = 1.96
+PORT = 5006
+
+# Simulates batches of BATCH_SIZE marker sets until stopped.
+class SimulationWorker(threading.Thread):
+
+  def __init__(self, computer, tolerances, seed=None, batch_size=BATCH_SIZE):
+    super().__init__(daemon=True)
+    self.computer = computer
+    self.tolerances = tolerances
+    self.rng = np.random.default_rng(seed)
+    self.batch_size = batch_size
+    self.histograms = [AlignmentHistogram() for _ in tolerances]
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.start_time = time.perf_counter()
+
+  def run(self):
+    while not self.stopped.is_set():
+      counts, _ = self.computer.simulated_counts(self.batch_size, tolerances=self.tolerances, rng=self.rng,
+                                                 progress=False)
+      with self.lock:
+        for k, histogram in enumerate(self.histograms):
+          histogram.add(counts[:, k])
+
+  def stop(self):
+    self.stopped.set()
+
+  # Copies of the histograms, safe to read while the simulation goes on.
+  def snapshot(self):
+    with self.lock:
+      return [AlignmentHistogram(h.bins.copy()) for h in self.histograms]
+
+# Bring source up to date with data, a dict of equal-length columns indexed
+# by count. Columns only grow while one histogram is shown, so existing rows
+# are patched and new ones streamed; anything else replaces the data.
+def update_source(source, data, reset=False):
+  n_old = len(source.data['count'])
+  n_new = len(data['count'])
+  if reset or n_old == 0 or n_new < n_old:
+    source.data = data
+    return
+  source.patch({name: [(slice(0, n_old), np.asarray(values[:n_old]).tolist())]
+                for (name, values) in data.items() if name != 'count'})
+  if n_new > n_old:
+    source.stream({name: values[n_old:] for (name, values) in data.items()})
+
+class Dashboard:
+
+  def __init__(self, doc, markers, targets=ALIGNMENT_TARGETS, tolerances=TOLERANCES, seed=SEED):
+    self.doc = doc
+    self.markers = markers
+    self.all_targets = targets
+    self.tolerances = tolerances
+    self.seed = seed
+    self.worker = None
+    self.reset = True
+    self.shown_total = 0
+
+    self.tolerance_select = Select(title='Tolerance (deg)', value=str(tolerances[len(tolerances) // 2]),
+                                   options=[str(t) for t in tolerances])
+    self.tolerance_select.on_change('value', lambda attr, old, new: self.show_tolerance())
+    self.target_checkboxes = CheckboxGroup(labels=[f'{t.category}: {t.name}' for t in targets],
+                                           active=list(range(len(targets))))
+    self.restart_button = Button(label='Restart with selected targets', button_type='primary')
+    self.restart_button.on_click(self.restart)
+    self.status = Div()
+
+    self.curve_source = ColumnDataSource(dict(count=[], p_value=[], lower=[], upper=[]))
+    self.density_source = ColumnDataSource(dict(count=[], left=[], right=[], pmf=[]))
+    self.trace_source = ColumnDataSource(dict(count=[], p_value=[], lower=[], upper=[]))
+
+    self.curve_figure = figure(title='P-value as function of alignments', sizing_mode='stretch_width', height=350)
+    self.curve_figure.add_layout(Band(base='count', lower='lower', upper='upper', source=self.curve_source,
+                                      fill_alpha=0.3, fill_color='navy'))
+    self.curve_figure.line(x='count', y='p_value', source=self.curve_source, line_width=3)
+    self.curve_figure.xaxis.axis_label = 'observed'
+    self.curve_figure.yaxis.axis_label = 'Pr(alignments > observed | random markers)'
+    self.curve_figure.y_range = Range1d(0, 1.05)
+    self.observed_span = Span(location=0, dimension='height', line_color='red', line_width=2)
+    self.curve_figure.add_layout(self.observed_span)
+    self.curve_figure.add_layout(Span(location=0.05, dimension='width', line_color='black', line_width=2))
+
+    self.density_figure = figure(title='Density of alignments', sizing_mode='stretch_width', height=350)
+    self.density_figure.quad(top='pmf', bottom=0, left='left', right='right', source=self.density_source,
+                             fill_color='navy', line_color='white', alpha=0.5)
+    self.density_figure.xaxis.axis_label = 'alignments'
+    self.density_figure.yaxis.axis_label = 'Pr(alignments | random markers)'
+
+    # One point per update, so this source is always streamed; its count
+    # column holds the number of simulations.
+    self.trace_figure = figure(title='P-value of the observed alignments', sizing_mode='stretch_width',
+                               height=350)
+    self.trace_figure.add_layout(Band(base='count', lower='lower', upper='upper', source=self.trace_source,
+                                      fill_alpha=0.3, fill_color='navy'))
+    self.trace_figure.line(x='count', y='p_value', source=self.trace_source, line_width=2)
+    self.trace_figure.xaxis.axis_label = 'simulations'
+    self.trace_figure.yaxis.axis_label = 'p-value'
+
+    controls = column(self.tolerance_select, self.target_checkboxes, self.restart_button, self.status, width=300)
+    doc.add_root(row(controls, column(self.curve_figure, self.density_figure, self.trace_figure,
+                                      sizing_mode='stretch_width'), sizing_mode='stretch_width'))
+    doc.title = 'Alignment significance'
+    doc.add_periodic_callback(self.update, UPDATE_INTERVAL)
+    doc.on_session_destroyed(lambda session_context: self.stop())
+    self.restart()
+
+  def stop(self):
+    if self.worker is not None:
+      self.worker.stop()
+
+  def restart(self):
+    self.stop()
+    self.targets = [self.all_targets[k] for k in sorted(self.target_checkboxes.active)]
+    computer = Computer(self.markers, self.targets, max(self.tolerances))
+    lat, lon = marker_coordinates(self.markers)
+    self.observed = computer.count_alignments_by_tolerance(lat, lon, self.tolerances)
+    self.worker = SimulationWorker(computer, self.tolerances, self.seed)
+    self.worker.start()
+    self.show_tolerance()
+
+  def show_tolerance(self):
+    self.reset = True
+    self.shown_total = 0
+    self.update()
+
+  def update(self):
+    k = self.tolerances.index(float(self.tolerance_select.value))
+    histogram = self.worker.snapshot()[k]
+    total = histogram.total()
+    if total == 0 or total == self.shown_total:
+      return
+    reset, self.reset = self.reset, False
+    self.shown_total = total
+
+    observed = int(self.observed[k])
+    counts = np.arange(max(histogram.max_count(), observed) + 2)
+    lower, upper = histogram.p_value_interval(counts, CONFIDENCE_Z)
+    update_source(self.curve_source, dict(count=counts, p_value=histogram.p_value(counts), lower=lower, upper=upper),
+                  reset)
+    bins = np.arange(histogram.max_count() + 1)
+    update_source(self.density_source, dict(count=bins, left=bins - 0.5, right=bins + 0.5,
+                                            pmf=histogram.pmf()[:len(bins)]), reset)
+
+    p_value = float(histogram.p_value(observed))
+    lower, upper = histogram.p_value_interval(observed, CONFIDENCE_Z)
+    point = dict(count=[total], p_value=[p_value], lower=[float(lower)], upper=[float(upper)])
+    if reset:
+      self.trace_source.data = point
+    else:
+      self.trace_source.stream(point)
+
+    self.observed_span.location = observed
+    rate = total / (time.perf_counter() - self.worker.start_time)
+    self.status.text = (f'<b>{len(self.targets)} targets, tolerance {self.tolerances[k]} deg</b><br>'
+                        f'observed alignments: {observed}<br>'
+                        f'simulations: {total} ({rate:.0f}/s)<br>'
+                        f'p-value: {p_value:.5f} ({lower:.5f} to {upper:.5f})')
+
+def read_markers():
+  data_reader = DataReader(DATA_FILE)
+  data_reader.read_marker_locations()
+  return data_reader.markers
+
+def make_document(doc):
+  Dashboard(doc, read_markers())
+
+
+def main(argv=None):
+  from bokeh.server.server import Server
+
+  parser = argparse.ArgumentParser(description='Serve a live view of the alignment simulation.')
+  parser.add_argument('--port', type=int, default=PORT)
+  parser.add_argument('--no-browser', action='store_true', help='do not open a browser')
+  args = parser.parse_args(argv)
+
+  server = Server({'/': make_document}, port=args.port)
+  server.start()
+  print(f'serving on http://localhost:{args.port}/')
+  if not args.no_browser:
+    server.io_loop.add_callback(server.show, '/')
+  server.io_loop.start()
+
+
+if __name__ == "__main__":
+  main()
+elif __name__.startswith('bokeh_app'):
+  make_document(curdoc())
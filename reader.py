@@ -1,28 +1,142 @@
+import hashlib
+import json
+import os
+import re
+import numpy as np
 import pandas as pd
-from pyproj import Transformer
-from geometry import Marker
+from projection import get_transformer
+from geometry import MarkerSet
+from utils import atomic_path
 
-# Class that reads in data from a csv and converts
-# from lat lon to x/y using pyproj.
+# Columns of a marker catalog. Positions are taken from the decimal
+# columns, or parsed from the degree/minute/second columns where the
+# decimal ones are missing or empty.
+NAME_COLUMN = 'LUGAR'
+LAT_COLUMN = 'Latitude (dec) (y)'
+LON_COLUMN = 'Longitude (dec) (x)'
+LAT_DMS_COLUMN = 'Latitude (deg) (y)'
+LON_DMS_COLUMN = 'Longitude (deg) (x)'
+
+# Optional column with the position error of each marker in metres.
+ERROR_COLUMN = 'Error (meters)'
+
+# Sheet holding the markers in Excel catalogs.
+MARKER_SHEET = 'Markers'
+
+# Directory for the parsed and projected catalogs. Entries are keyed by a
+# hash of the source file, so editing the catalog invalidates them.
+CATALOG_CACHE_DIR = './cache/catalogs'
+CATALOG_CACHE_VERSION = 2
+
+DMS_PATTERN = re.compile(r'^\s*([NSEW])?\s*(\d+(?:\.\d*)?)(?:\s+(\d+(?:\.\d*)?))?(?:\s+(\d+(?:\.\d*)?))?\s*([NSEW])?\s*$')
+
+# Parse a degree/minute/second string such as 'S   11 46 32.4' into signed
+# decimal degrees. Returns nan for empty values.
+def parse_dms(value):
+  if not isinstance(value, str):
+    return np.nan if value is None or pd.isna(value) else float(value)
+  if value.strip() == '':
+    return np.nan
+
+  match = DMS_PATTERN.match(value.upper())
+  if match is None:
+    raise ValueError(f'cannot parse degrees/minutes/seconds from {value!r}')
+  prefix, degrees, minutes, seconds, suffix = match.groups()
+  decimal = float(degrees) + float(minutes or 0) / 60 + float(seconds or 0) / 3600
+  return -decimal if (prefix or suffix) in ('S', 'W') else decimal
+
+# Class that reads in data from a csv or Excel catalog and converts
+# from lat lon to x/y using pyproj. Markers are loaded straight into a
+# MarkerSet; rows without a position, such as section headers like
+# "North Side", are skipped. The parsed catalog is cached as a memory-mapped
+# array unless cache_dir is None.
 class DataReader:
 
-  def __init__(self, filename: str):
+  def __init__(self, filename: str, sheet_name=MARKER_SHEET, cache_dir=CATALOG_CACHE_DIR):
     self.filename = filename
+    self.sheet_name = sheet_name
+    self.cache_dir = cache_dir
     self.markers = None
 
   def read_marker_locations(self):
-    df = pd.read_csv(self.filename,
-                     usecols=['LUGAR', 'Latitude (dec) (y)', 'Longitude (dec) (x)'])
-    df = df.dropna()
+    cache_path = self.cache_path() if self.cache_dir is not None else None
+    if cache_path is not None and os.path.exists(cache_path + '.npy'):
+      self.markers = self.load_cache(cache_path)
+      return
+
+    df = self.read_table()
+    names, lat, lon, errors = self.validate(df)
+
+    transformer = get_transformer("epsg:4326", "epsg:3857")
+    x, y = transformer.transform(lat, lon)
+    self.markers = MarkerSet(x, y, lat, lon, names, errors)
+
+    if cache_path is not None:
+      self.save_cache(cache_path)
+
+  def read_table(self):
+    if os.path.splitext(self.filename)[1].lower() in ('.xlsx', '.xls'):
+      return pd.read_excel(self.filename, sheet_name=self.sheet_name)
+    return pd.read_csv(self.filename, encoding='utf-8-sig')
+
+  # Check the columns and values of the catalog, returning the names,
+  # positions and errors (nan if not given) of the rows that have a
+  # position.
+  def validate(self, df):
+    has_decimal = LAT_COLUMN in df.columns and LON_COLUMN in df.columns
+    has_dms = LAT_DMS_COLUMN in df.columns and LON_DMS_COLUMN in df.columns
+    if NAME_COLUMN not in df.columns or not (has_decimal or has_dms):
+      raise ValueError(f'{self.filename}: expected a {NAME_COLUMN!r} column and either '
+                       f'{LAT_COLUMN!r}/{LON_COLUMN!r} or {LAT_DMS_COLUMN!r}/{LON_DMS_COLUMN!r}; '
+                       f'found {list(df.columns)}')
+
+    lat = np.full(len(df), np.nan)
+    lon = np.full(len(df), np.nan)
+    if has_decimal:
+      lat = pd.to_numeric(df[LAT_COLUMN], errors='coerce').to_numpy(dtype=np.float64)
+      lon = pd.to_numeric(df[LON_COLUMN], errors='coerce').to_numpy(dtype=np.float64)
+    if has_dms:
+      lat = np.where(np.isnan(lat), [parse_dms(v) for v in df[LAT_DMS_COLUMN]], lat)
+      lon = np.where(np.isnan(lon), [parse_dms(v) for v in df[LON_DMS_COLUMN]], lon)
+
+    errors = np.full(len(df), np.nan)
+    if ERROR_COLUMN in df.columns:
+      errors = pd.to_numeric(df[ERROR_COLUMN], errors='coerce').to_numpy(dtype=np.float64)
+
+    keep = df[NAME_COLUMN].notna().to_numpy() & ~np.isnan(lat) & ~np.isnan(lon)
+    lat = lat[keep]
+    lon = lon[keep]
+    errors = errors[keep]
+    if np.any(np.abs(lat) > 90) or np.any(np.abs(lon) > 180):
+      raise ValueError(f'{self.filename}: latitude or longitude out of range')
+    if np.any(errors < 0):
+      raise ValueError(f'{self.filename}: negative {ERROR_COLUMN!r}')
+
+    return df[NAME_COLUMN][keep].astype(str).tolist(), lat, lon, errors
+
+  def cache_path(self):
+    digest = hashlib.sha256()
+    with open(self.filename, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        digest.update(block)
+    digest.update(repr((CATALOG_CACHE_VERSION, self.sheet_name)).encode())
+    return os.path.join(self.cache_dir, digest.hexdigest())
 
-    df['lon'] = df['Longitude (dec) (x)']
-    df['lat'] = df['Latitude (dec) (y)']
+  # Coordinates are stored as one (5, N) float64 array so that each of
+  # x, y, lat, lon and errors is a contiguous row of the memory map.
+  def load_cache(self, cache_path):
+    with open(cache_path + '.json') as f:
+      names = json.load(f)
+    x, y, lat, lon, errors = np.load(cache_path + '.npy', mmap_mode='r')
+    return MarkerSet(x, y, lat, lon, names, errors)
 
-    transformer = Transformer.from_crs("epsg:4326", "epsg:3857")
-    df['x'], df['y'] = transformer.transform(df['lat'], df['lon'])
+  # Names are written before the array, each file atomically, so a cache
+  # entry is only used once it is complete.
+  def save_cache(self, cache_path):
+    os.makedirs(self.cache_dir, exist_ok=True)
+    with atomic_path(cache_path + '.json') as temporary, open(temporary, 'w') as f:
+      json.dump(self.markers.names, f)
 
-    self.markers = [Marker(x0, y0, lat, lon, name) for (x0, y0, lat, lon, name) in zip(df['x'],
-                                                                                       df['y'],
-                                                                                       df['lat'],
-                                                                                       df['lon'],
-                                                                                       df['LUGAR'])]
+    coordinates = np.stack([self.markers.x, self.markers.y, self.markers.lat, self.markers.lon, self.markers.errors])
+    with atomic_path(cache_path + '.npy') as temporary:
+      np.save(temporary, coordinates)
@@ -0,0 +1,140 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from bokeh.embed import file_html, json_item
+from bokeh.io import export_png, export_svgs
+from bokeh.resources import INLINE
+from computer import Computer, marker_coordinates, pair_azimuths
+from grapher import CircleGrapher, LocationGrapher, SignificanceGrapher, DensityGrapher
+
+# Height in pixels of each figure in the single-page HTML bundle.
+BUNDLE_FIGURE_HEIGHT = 700
+
+# Page of the HTML bundle. Every figure is a JSON item returned by the
+# worker that built it, embedded into its own div.
+BUNDLE_TEMPLATE = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+{resources}
+</head>
+<body>
+{divs}
+<script type="text/javascript">
+{embeds}
+</script>
+</body>
+</html>
+'''
+
+def circle_figure(markers, targets):
+  grapher = CircleGrapher(pair_azimuths(markers), targets)
+  grapher.graph()
+  return grapher.p
+
+def location_figure(markers, targets, tolerance, tiles):
+  grapher = LocationGrapher(markers, tolerance, tiles=tiles)
+  grapher.graph()
+  computer = Computer(markers, targets, tolerance)
+  grapher.plot_alignments(computer.determine_alignments(markers))
+  return grapher.p
+
+def significance_figure(n_markers, tolerance, histogram, observed_alignments):
+  grapher = SignificanceGrapher(n_markers, tolerance, histogram)
+  grapher.graph(observed_alignments=observed_alignments)
+  return grapher.p
+
+def density_figure(n_markers, tolerance, histogram):
+  grapher = DensityGrapher(n_markers, tolerance, histogram)
+  grapher.graph()
+  return grapher.p
+
+FIGURES = {'circle': circle_figure,
+           'location': location_figure,
+           'significance': significance_figure,
+           'density': density_figure}
+
+# One figure per task: (kind, arguments for its builder, file name without
+# extension).
+def report_tasks(markers, targets, tolerances, histograms, tiles=False, num_examples=1, seed=None):
+  tasks = [('circle', (markers, targets), 'circle')]
+  rng = np.random.default_rng(seed)
+  lat, lon = marker_coordinates(markers)
+  observed = Computer(markers, targets, max(tolerances)).count_alignments_by_tolerance(lat, lon, tolerances)
+  for tolerance, histogram, observed_alignments in zip(tolerances, histograms, observed):
+    computer = Computer(markers, targets, tolerance)
+    tasks.append(('location', (markers, targets, tolerance, tiles), f'location_{tolerance}'))
+    for k in range(num_examples):
+      example = computer.random_markers(rng)
+      tasks.append(('location', (example, targets, tolerance, tiles), f'location_{tolerance}_example_{k}'))
+    tasks.append(('significance', (len(markers), tolerance, histogram, int(observed_alignments)),
+                  f'significance_{tolerance}'))
+    tasks.append(('density', (len(markers), tolerance, histogram), f'density_{tolerance}'))
+  return tasks
+
+# Process pool task: build one figure and write it to output_dir. Returns
+# the file name and, with bundle, the figure resized for the bundle as a
+# JSON item (see bokeh.embed.json_item), else None.
+def export_figure(kind, args, name, output_dir, fmt, bundle=False):
+  p = FIGURES[kind](*args)
+  filename = os.path.join(output_dir, f'{name}.{fmt}')
+  if fmt == 'html':
+    with open(filename, 'w') as f:
+      f.write(file_html(p, INLINE, title=name))
+  elif fmt == 'png':
+    export_png(p, filename=filename)
+  elif fmt == 'svg':
+    backend, p.output_backend = p.output_backend, 'svg'
+    export_svgs(p, filename=filename)
+    p.output_backend = backend
+  else:
+    raise ValueError(f'unknown format {fmt}')
+
+  if not bundle:
+    return filename, None
+  p.sizing_mode = 'stretch_width'
+  p.height = BUNDLE_FIGURE_HEIGHT
+  return filename, json_item(p, name)
+
+# Single page with all figures, from the JSON items of export_figure.
+def bundle_html(items, title):
+  divs = '\n'.join(f'<div id="{item["target_id"]}"></div>' for item in items)
+  # Keep '</script>' in figure text from closing the script element.
+  embeds = '\n'.join(f'Bokeh.embed.embed_item({json.dumps(item)});'.replace('</', '<\\/') for item in items)
+  return BUNDLE_TEMPLATE.format(title=title, resources=INLINE.render(), divs=divs, embeds=embeds)
+
+# Headless report: every figure that alignment_significance.main would show
+# (the circle diagram, and per tolerance the observed and example simulated
+# locations, the p-value curve and the density) is written to output_dir
+# instead. Figures are built and exported in a process pool. Formats are
+# 'html' (self-contained, no network needed to view), 'png' and 'svg' (both
+# need selenium and a browser driver). With bundle, all figures are also
+# written to a single report.html, assembled from the JSON items the
+# workers return so that no figure is built twice. With tiles=False no map
+# tiles are requested, so nothing is fetched from the network.
+def write_report(markers, targets, tolerances, histograms, output_dir, fmt='html', tiles=False,
+                 num_examples=1, seed=None, bundle=True, max_workers=None):
+  os.makedirs(output_dir, exist_ok=True)
+  tasks = report_tasks(markers, targets, tolerances, histograms, tiles, num_examples, seed)
+
+  filenames = []
+  items = []
+  with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    futures = [executor.submit(export_figure, kind, args, name, output_dir, fmt, bundle)
+               for (kind, args, name) in tasks]
+    for future in futures:
+      filename, item = future.result()
+      filenames.append(filename)
+      items.append(item)
+      print(f'wrote {filename}')
+
+  if bundle:
+    filename = os.path.join(output_dir, 'report.html')
+    with open(filename, 'w') as f:
+      f.write(bundle_html(items, 'Alignment significance'))
+    filenames.append(filename)
+    print(f'wrote {filename}')
+
+  return filenames
@@ -0,0 +1,103 @@
+import numpy as np
+
+# Adaptive multilevel splitting estimate of tail probabilities of the
+# alignment count under the null hypothesis, for observed counts far in the
+# tail where plain Computer.simulate would need millions of iterations.
+#
+# A population of simulated marker sets is pushed up through a sequence of
+# alignment-count levels. At each level the fraction of sets at or above
+# the level is recorded, the survivors are resampled back to full size, and
+# every set is moved by Metropolis steps that re-place one marker uniformly
+# in the disc and are only accepted if the set stays at or above the level.
+# The tail probability is the product of the recorded fractions.
+#
+# Independent runs are repeated, each with its own SeedSequence child,
+# until the standard error of their mean falls below relative_error of the
+# estimate or max_runs is reached.
+class SplittingEstimator:
+
+  def __init__(self, computer, n_particles=1000, keep_fraction=0.2, mcmc_steps=5):
+    self.computer = computer
+    self.n_particles = n_particles
+    self.keep_fraction = keep_fraction
+    self.mcmc_steps = mcmc_steps
+
+  # Alignment counts of a population of marker sets, scored in batches of
+  # computer.default_batch_size() sets so that memory does not grow with
+  # n_particles.
+  def count(self, x, y):
+    batch_size = self.computer.default_batch_size()
+    counts = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), batch_size):
+      stop = start + batch_size
+      counts[start:stop] = self.computer.count_xy_alignments(x[start:stop], y[start:stop])
+    return counts
+
+  # Pr(alignments >= level) for each of the increasing levels, from one run.
+  def tail_probabilities(self, levels, rng):
+    x, y = self.computer.random_marker_xy(self.n_particles, rng)
+    counts = self.count(x, y)
+
+    probabilities = []
+    probability = 1.0
+    current = -1
+    for level in levels:
+      while current < level:
+        # Next level: the (1 - keep_fraction) quantile of the population,
+        # stepping at least one count and never past the level we want.
+        quantile = int(np.ceil(np.quantile(counts, 1 - self.keep_fraction)))
+        current = min(max(quantile, current + 1), level)
+
+        survivors = np.flatnonzero(counts >= current)
+        probability *= len(survivors) / self.n_particles
+        if len(survivors) == 0:
+          return probabilities + [0.0] * (len(levels) - len(probabilities))
+
+        chosen = rng.choice(survivors, size=self.n_particles)
+        x, y, counts = x[chosen], y[chosen], counts[chosen]
+        x, y, counts = self.move(x, y, counts, current, rng)
+
+      probabilities.append(probability)
+
+    return probabilities
+
+  # Metropolis moves restricted to marker sets with at least level alignments.
+  def move(self, x, y, counts, level, rng):
+    rows = np.arange(len(x))
+    for _ in range(self.mcmc_steps):
+      moved = rng.integers(x.shape[1], size=len(x))
+      new_x, new_y = self.computer.random_disc_xy(len(x), rng)
+      proposed_x = x.copy()
+      proposed_y = y.copy()
+      proposed_x[rows, moved] = new_x
+      proposed_y[rows, moved] = new_y
+
+      proposed_counts = self.count(proposed_x, proposed_y)
+      accept = proposed_counts >= level
+      x[accept] = proposed_x[accept]
+      y[accept] = proposed_y[accept]
+      counts[accept] = proposed_counts[accept]
+
+    return x, y, counts
+
+  # Mid-rank p-value Pr(alignments > observed) + 0.5 Pr(alignments ==
+  # observed), as in AlignmentHistogram.p_value, with its standard error
+  # over runs.
+  def p_value(self, observed_alignments, seed=None, relative_error=0.1, min_runs=5, max_runs=100):
+    levels = [observed_alignments, observed_alignments + 1]
+    seeds = np.random.SeedSequence(seed).spawn(max_runs)
+
+    estimates = []
+    for run in range(max_runs):
+      at_least, above = self.tail_probabilities(levels, np.random.default_rng(seeds[run]))
+      estimates.append(0.5 * (at_least + above))
+
+      if len(estimates) >= min_runs:
+        estimate = np.mean(estimates)
+        standard_error = np.std(estimates, ddof=1) / np.sqrt(len(estimates))
+        if standard_error <= relative_error * estimate:
+          break
+
+    estimate = float(np.mean(estimates))
+    standard_error = float(np.std(estimates, ddof=1) / np.sqrt(len(estimates))) if len(estimates) > 1 else np.inf
+    return estimate, standard_error
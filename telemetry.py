@@ -0,0 +1,172 @@
+import cProfile
+import json
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+# Instrumentation of long simulations. A Telemetry accumulates wall time per
+# named stage (rng, projection, azimuths, matching, counting) and counters
+# (iterations, matches), and writes them as JSON lines: a 'progress' record
+# with iterations per second, matches per iteration and an ETA after every
+# batch or chunk, and 'start'/'end' records around a run. A run can also be
+# profiled with cProfile (stats written to a file for pstats/snakeviz) and
+# traced with tracemalloc (peak memory in the 'end' record); both only see
+# the calling process, so simulate_parallel must then run with
+# max_workers=0.
+#
+# Computers use NULL_TELEMETRY unless given one, whose methods do nothing,
+# so instrumented code costs one method call per stage and batch when
+# telemetry is off.
+
+class Telemetry:
+  enabled = True
+
+  def __init__(self, stream=sys.stderr, profile=None, trace_memory=False):
+    self.stream = stream
+    self.profile = profile
+    self.trace_memory = trace_memory
+    self.profiler = None
+    self.reset()
+
+  def reset(self):
+    self.start_time = time.perf_counter()
+    self.stage_times = defaultdict(float)
+    self.counters = defaultdict(int)
+
+  # Workers get a copy without the stream or profiler that only
+  # accumulates, see merge.
+  def __getstate__(self):
+    return {'stream': None, 'profile': None, 'trace_memory': False, 'profiler': None,
+            'start_time': time.perf_counter(), 'stage_times': defaultdict(float), 'counters': defaultdict(int)}
+
+  @contextmanager
+  def stage(self, name):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.stage_times[name] += time.perf_counter() - start
+
+  def count(self, name, value=1):
+    self.counters[name] += value
+
+  # Add stage times and counters collected elsewhere, e.g. in a worker.
+  # Stage times of parallel workers add up to more than the wall time.
+  def merge(self, stage_times, counters):
+    for name, seconds in stage_times.items():
+      self.stage_times[name] += seconds
+    for name, value in counters.items():
+      self.counters[name] += value
+
+  def snapshot(self):
+    return dict(self.stage_times), dict(self.counters)
+
+  def emit(self, event, **fields):
+    if self.stream is None:
+      return
+    self.stream.write(json.dumps(dict(event=event, time=time.time(), **fields)) + '\n')
+    self.stream.flush()
+
+  def progress(self, done, total):
+    elapsed = time.perf_counter() - self.start_time
+    rate = done / elapsed if elapsed > 0 else 0.0
+    self.emit('progress', done=done, total=total, elapsed=elapsed,
+              iterations_per_second=rate,
+              matches_per_iteration=self.counters['matches'] / max(self.counters['iterations'], 1),
+              eta=(total - done) / rate if rate > 0 else None,
+              stages=dict(self.stage_times),
+              counters=dict(self.counters))
+
+  # Flushes and closes the stream unless it is stderr; later records are
+  # dropped. A Telemetry is also a context that closes it on exit.
+  def close(self):
+    if self.stream is None:
+      return
+    self.stream.flush()
+    if self.stream is not sys.stderr:
+      self.stream.close()
+    self.stream = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  # Context for a whole run: resets the timers, starts the profiler and
+  # memory tracing if requested, and writes 'start' and 'end' records.
+  @contextmanager
+  def run(self, name):
+    self.reset()
+    self.emit('start', run=name)
+    if self.trace_memory:
+      tracemalloc.start()
+    if self.profile is not None:
+      self.profiler = cProfile.Profile()
+      self.profiler.enable()
+
+    try:
+      yield self
+    finally:
+      fields = {}
+      if self.profiler is not None:
+        self.profiler.disable()
+        self.profiler.dump_stats(self.profile)
+        self.profiler = None
+        fields['profile'] = self.profile
+      if self.trace_memory:
+        _, fields['peak_memory'] = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+      self.emit('end', run=name, elapsed=time.perf_counter() - self.start_time,
+                stages=dict(self.stage_times), counters=dict(self.counters), **fields)
+
+# Telemetry that records nothing.
+class NullTelemetry:
+  enabled = False
+
+  def stage(self, name):
+    return NULL_CONTEXT
+
+  def count(self, name, value=1):
+    pass
+
+  def merge(self, stage_times, counters):
+    pass
+
+  def snapshot(self):
+    return {}, {}
+
+  def emit(self, event, **fields):
+    pass
+
+  def progress(self, done, total):
+    pass
+
+  def run(self, name):
+    return NULL_CONTEXT
+
+  def close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    pass
+
+NULL_CONTEXT = nullcontext()
+NULL_TELEMETRY = NullTelemetry()
+
+# Telemetry writing JSON lines to filename ('-' for stderr), or
+# NULL_TELEMETRY if neither a file, a profile nor memory tracing is asked for.
+# The caller closes it, e.g. with a with statement, to close the file.
+def open_telemetry(filename=None, profile=None, trace_memory=False):
+  if filename is None and profile is None and not trace_memory:
+    return NULL_TELEMETRY
+  if filename is None or filename == '-':
+    stream = sys.stderr
+  else:
+    stream = open(filename, 'a')
+  return Telemetry(stream, profile, trace_memory)
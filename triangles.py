@@ -1,91 +1,104 @@
 #!/usr/local/bin/python3
-import pandas as pd
 import numpy as np
-import bisect
 import plotly.express as px
+import plotly.graph_objects as go
 
 THREE = 3
 
+# Bins per angle axis over [-pi, pi), and triangles drawn per chunk. Memory
+# is set by these, not by n: a chunk needs about 200 bytes per triangle and
+# the 3-D histogram BINS^3 counts.
+BINS = 90
+CHUNK_SIZE = 2 ** 18
+
+# Bins per axis of the 3-D plot, so the browser gets at most PLOT_BINS^3
+# points. Must divide BINS.
+PLOT_BINS = 30
+
+# Directed edge angle used for each axis by the eight combinations: index 0
+# is the forward edge i -> i+1, 1 the backward edge i+1 -> i.
+COMBINATIONS = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [1, 1, 0],
+                         [0, 0, 1], [1, 0, 1], [0, 1, 1], [1, 1, 1]])
+
+# Distribution of the edge angles of triangles with vertices uniformly
+# distributed in the unit disc. For every triangle, the directed angles of
+# its three edges (both directions, so eight combinations) are binned
+# into a 3-D histogram, accumulated chunk by chunk.
 class Triangles:
 
-	def __init__(self, n):
+	def __init__(self, n, bins=BINS, chunk_size=CHUNK_SIZE, rng=None):
 		self.n = n
-		self.triplets = {'x':list(),
-						 'y':list(),
-						 'z':list()}
-
+		self.bins = bins
+		self.chunk_size = chunk_size
+		self.rng = np.random if rng is None else rng
+		self.edges = np.linspace(-np.pi, np.pi, bins + 1)
+		self.histogram = np.zeros((bins, bins, bins), dtype=np.int64)
 
 	def simulate(self):
-		for i in range(self.n):
-			x, y = self.random_markers()
-			triplet = list()
-			for i in range(THREE):
-				j = (i + 1) % THREE
-				angle = np.arctan2(y[j] - y[i], x[j] - x[i])
-				triplet.append(angle)
-				angle = np.arctan2(y[i] - y[j], x[i] - x[j])
-				triplet.append(angle)
-
-			self.triplets['x'].append(triplet[0])
-			self.triplets['y'].append(triplet[2])
-			self.triplets['z'].append(triplet[4])
-
-			self.triplets['x'].append(triplet[1])
-			self.triplets['y'].append(triplet[2])
-			self.triplets['z'].append(triplet[4])
-
-			self.triplets['x'].append(triplet[0])
-			self.triplets['y'].append(triplet[3])
-			self.triplets['z'].append(triplet[4])
-
-			self.triplets['x'].append(triplet[1])
-			self.triplets['y'].append(triplet[3])
-			self.triplets['z'].append(triplet[4])
-
-			self.triplets['x'].append(triplet[0])
-			self.triplets['y'].append(triplet[2])
-			self.triplets['z'].append(triplet[5])
-
-			self.triplets['x'].append(triplet[1])
-			self.triplets['y'].append(triplet[2])
-			self.triplets['z'].append(triplet[5])
-
-			self.triplets['x'].append(triplet[0])
-			self.triplets['y'].append(triplet[3])
-			self.triplets['z'].append(triplet[5])
-
-			self.triplets['x'].append(triplet[1])
-			self.triplets['y'].append(triplet[3])
-			self.triplets['z'].append(triplet[5])
-
-	def plot(self):
-		df = pd.DataFrame(self.triplets)
-		fig = px.scatter_3d(df, x='x', y='y', z='z')
-		fig.update_traces(marker={'size': 3}, opacity=0.01)
+		for start in range(0, self.n, self.chunk_size):
+			stop = min(start + self.chunk_size, self.n)
+			x, y = self.random_markers(stop - start)
+			self.add(self.edge_angles(x, y))
+			print(f'triangle {stop} / {self.n}')
+
+	# Directed edge angles of triangles given by (m, 3) vertex arrays, as an
+	# (m, 2, 3) array: [:, 0, i] is the angle of the edge from vertex i to
+	# i+1, [:, 1, i] that of the edge back.
+	@staticmethod
+	def edge_angles(x, y):
+		dx = np.roll(x, -1, axis=1) - x
+		dy = np.roll(y, -1, axis=1) - y
+		return np.stack([np.arctan2(dy, dx), np.arctan2(-dy, -dx)], axis=1)
+
+	# Bin the eight combinations of every triangle's angles.
+	def add(self, angles):
+		bins = np.floor((angles + np.pi) * (self.bins / (2 * np.pi))).astype(np.int64)
+		np.clip(bins, 0, self.bins - 1, out=bins)
+		bx = bins[:, COMBINATIONS[:, 0], 0]
+		by = bins[:, COMBINATIONS[:, 1], 1]
+		bz = bins[:, COMBINATIONS[:, 2], 2]
+		flat = ((bx * self.bins + by) * self.bins + bz).ravel()
+		self.histogram += np.bincount(flat, minlength=self.bins ** 3).reshape(self.histogram.shape)
+
+	# Probability density over (x, y, z) angles, or over (x, y) if the z axis
+	# is summed out.
+	def density(self, axes=3):
+		counts = self.histogram if axes == 3 else self.histogram.sum(axis=2)
+		width = self.edges[1] - self.edges[0]
+		return counts / (counts.sum() * width ** axes)
+
+	def plot(self, plot_bins=PLOT_BINS):
+		centers = (self.edges[:-1] + self.edges[1:]) / 2
+
+		# Merge groups of bins for the 3-D plot.
+		factor = self.bins // plot_bins
+		density = self.density().reshape(plot_bins, factor, plot_bins, factor, plot_bins, factor).mean(axis=(1, 3, 5))
+		plot_centers = centers.reshape(plot_bins, factor).mean(axis=1)
+		i, j, k = np.nonzero(density)
+		fig = go.Figure(go.Scatter3d(x=plot_centers[i], y=plot_centers[j], z=plot_centers[k], mode='markers',
+		                             marker={'size': 3, 'color': density[i, j, k], 'colorscale': 'Viridis',
+		                                     'opacity': 0.1, 'colorbar': {'title': 'density'}}))
+		fig.update_layout(scene={'xaxis_title': 'x', 'yaxis_title': 'y', 'zaxis_title': 'z'})
 		fig.show()
 
-		fig = px.scatter(df, x='x', y='y')
-		fig.update_traces(marker={'size': 3}, opacity=0.05)
+		fig = px.imshow(self.density(axes=2).T, x=centers, y=centers, origin='lower',
+		                labels={'x': 'x', 'y': 'y', 'color': 'density'})
 		fig.update_yaxes(
 			scaleanchor='x',
 			scaleratio=1
 		)
 		fig.show()
 
-	def random_markers(self):
-		
-		r2 = np.random.uniform(0, 1, size=THREE)
-		angle = np.random.uniform(0, 2 * np.pi, size=THREE)
-		r = np.apply_along_axis(np.sqrt, 0, r2)
-		cos = np.apply_along_axis(np.cos, 0, angle)
-		sin = np.apply_along_axis(np.sin, 0, angle)
-		x = np.multiply(r, cos)
-		y = np.multiply(r, sin)
-		return x, y
+	# Vertices of n triangles uniformly distributed in the unit disc, as
+	# (n, 3) x and y arrays.
+	def random_markers(self, n=1):
+		r = np.sqrt(self.rng.uniform(0, 1, size=(n, THREE)))
+		angle = self.rng.uniform(0, 2 * np.pi, size=(n, THREE))
+		return r * np.cos(angle), r * np.sin(angle)
 
 
 def main():
-	n = 50000
+	n = 10 ** 7
 	triangles = Triangles(n)
 	triangles.simulate()
 	triangles.plot()
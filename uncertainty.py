@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+
+# Quantiles reported for the observed counts and p-values of perturbed
+# catalogs.
+QUANTILES = [0.05, 0.5, 0.95]
+SIGNIFICANCE = 0.05
+
+# Sensitivity of the observed result to the markers' stated position
+# errors: num_copies jittered copies of the catalog (see
+# Computer.perturbed_counts) are scored at every tolerance, and each copy's
+# count is turned into a p-value with the simulated histogram of that
+# tolerance. Returns one row per tolerance with the unperturbed count and
+# p-value, quantiles of the perturbed counts and p-values, and the fraction
+# of copies below SIGNIFICANCE. Also returns the (num_copies, T) counts.
+def positional_uncertainty(computer, tolerances, histograms, num_copies, seed=None, error_scale=1.0):
+  rng = np.random.default_rng(seed)
+  counts = computer.perturbed_counts(num_copies, tolerances, rng=rng, error_scale=error_scale)
+  observed = computer.count_alignments_by_tolerance(computer.marker_set.lat, computer.marker_set.lon, tolerances)
+
+  rows = []
+  for k, (tolerance, histogram) in enumerate(zip(tolerances, histograms)):
+    p_values = histogram.p_value(counts[:, k])
+    row = {'tolerance': tolerance,
+           'observed_alignments': int(observed[k]),
+           'p_value': float(histogram.p_value(observed[k])),
+           'mean_alignments': counts[:, k].mean()}
+    for q in QUANTILES:
+      row[f'alignments_q{q:g}'] = np.quantile(counts[:, k], q)
+    for q in QUANTILES:
+      row[f'p_value_q{q:g}'] = np.quantile(p_values, q)
+    row['fraction_significant'] = np.mean(p_values < SIGNIFICANCE)
+    rows.append(row)
+  return pd.DataFrame(rows), counts
@@ -1,3 +1,5 @@
+import os
+from contextlib import contextmanager
 import numpy as np
 
 def deg2rad(deg: float):
@@ -5,3 +7,24 @@ def deg2rad(deg: float):
 
 def rad2deg(rad: float):
   return ((180.0 / np.pi) * rad) % 360
+
+# Absolute difference between azimuths in degrees, taking the
+# wrap at 0/360 into account. Always in [0, 180].
+def angular_difference(azimuth1, azimuth2):
+  return np.abs((np.subtract(azimuth1, azimuth2) + 180.0) % 360 - 180.0)
+
+# Context giving a temporary file name in the same directory as path, which
+# is renamed to path when the block finishes without an error. A crash
+# while writing leaves the previous contents of path intact, and readers
+# never see a half-written file. The temporary keeps path's extension, since
+# np.save and np.savez append their own otherwise.
+@contextmanager
+def atomic_path(path):
+  root, extension = os.path.splitext(path)
+  temporary = f'{root}.{os.getpid()}.tmp{extension}'
+  try:
+    yield temporary
+    os.replace(temporary, path)
+  finally:
+    if os.path.exists(temporary):
+      os.remove(temporary)